@@ -2,12 +2,98 @@ import argparse
 import sys
 
 
+def block_size(value):
+    return value if value == 'auto' else positive_int(value)
+
+
+def probability(value):
+    try:
+        number = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('{} is not a number between 0 and 1'.format(value))
+    if not 0 < number < 1:
+        raise argparse.ArgumentTypeError('{} is not a number between 0 and 1'.format(value))
+    return number
+
+
+def positive_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('{} is not a positive integer'.format(value))
+    if number <= 0:
+        raise argparse.ArgumentTypeError('{} is not a positive integer'.format(value))
+    return number
+
+
 parser = argparse.ArgumentParser(description='TBD: some description.')
 parser.add_argument('-p', '--path', required=True,  help='Path to directory to scan')
-parser.add_argument('-a', '--alg', choices=['sha1', 'sha256', 'sha512', 'md5'], default='sha1', help='Hashing algorithm')
+parser.add_argument('-a', '--alg', nargs='+', choices=['sha1', 'sha256', 'sha512', 'md5', 'auto'], default=['sha1'],
+                    help='Hashing algorithms. Files are read once, grouped by the first one and all digests are shown. '
+                         'Auto picks the fastest one on this host')
 parser.add_argument('-u', '--unit', choices=['kb', 'mb', 'gb', 'tb'], default='gb', help='Unit of measuring size of files')
 parser.add_argument('-m', '--max', type=int,  default=sys.maxsize, help='Max files to check in directory')
 parser.add_argument('-o', '--output', default='results.txt', help='Output results to txt file')
 parser.add_argument('-l', '--log', default='log.txt', help='File for logging')
 parser.add_argument('-q', '--quiet', action='store_true', help='Turn off console output')
 parser.add_argument('-v', '--verbose', action='store_true', help='Show duplicates in console')
+parser.add_argument('-j', '--journal', help='Journal file for hashed files. Allows to resume interrupted hashing')
+parser.add_argument('-r', '--resume', action='store_true', help='Skip files already hashed in journal file')
+parser.add_argument('--dedupe', choices=['auto', 'reflink', 'hardlink'],
+                    help='Replace duplicated files with reflinks or hardlinks. Auto mode prefers reflinks')
+parser.add_argument('--dedupe-journal', default='dedupe_journal.txt', help='Journal file for replaced files')
+parser.add_argument('--rollback', action='store_true', help='Roll back replaced files from dedupe journal')
+parser.add_argument('--chunks', action='store_true', help='Index content-defined chunks to measure partial duplication')
+parser.add_argument('--archives', action='store_true', help='Check members of zip and tar archives as separate files')
+parser.add_argument('--max-memory', type=float, default=0,
+                    help='Memory limit in MB for found files. Files over limit are sorted on disk (0 - no limit)')
+parser.add_argument('--scratch-dir', help='Directory for sorted run files, system temp directory by default')
+parser.add_argument('--columnar', action='store_true',
+                    help='Keep found files in columnar arrays, group them with NumPy and collapse hardlinks')
+parser.add_argument('--daemon', metavar='SOCKET',
+                    help='Keep index of found files in memory and answer lookup requests on Unix socket')
+parser.add_argument('--top', type=positive_int, metavar='N', help='Show only N groups with the biggest size of duplicated files')
+parser.add_argument('--pager', action='store_true', help='Show list of duplicates page by page')
+parser.add_argument('--cache-polite', action='store_true',
+                    help='Read files sequentially and drop hashed blocks from page cache')
+parser.add_argument('--readahead', type=int, default=1024, metavar='KB', help='Readahead window in cache-polite mode')
+parser.add_argument('-b', '--block-size', type=block_size, default=65536,
+                    help='Read size in bytes. Auto picks the fastest one on this host')
+parser.add_argument('-x', '--one-filesystem', action='store_true', help='Do not walk directories on other filesystems')
+parser.add_argument('--exclude-fstype', nargs='+', metavar='FSTYPE',
+                    help='Do not walk mount points of these filesystem types, e.g. proc nfs fuse')
+parser.add_argument('-L', '--follow-links', action='store_true', help='Walk symlinked directories, every one only once')
+parser.add_argument('-w', '--walkers', type=int, default=1, help='Number of workers listing directories concurrently')
+parser.add_argument('--trees', action='store_true',
+                    help='Find duplicated directory trees and show them instead of their files')
+parser.add_argument('--tree-cache', default='tree_cache.json',
+                    help='Cache of duplicated trees. Their files are not read again while they are not changed')
+parser.add_argument('--max-read-rate', type=float, default=0, metavar='MB',
+                    help='Limit of read rate in MB per second for hashing (0 - no limit)')
+parser.add_argument('--max-open-rate', type=float, default=0, metavar='FILES',
+                    help='Limit of opened files per second for hashing (0 - no limit)')
+parser.add_argument('--throttle-control', metavar='FILE',
+                    help='JSON file with max_read_rate and max_open_rate to change limits of running check. '
+                         'It is re-read when modified or on SIGUSR1')
+parser.add_argument('--estimate', action='store_true',
+                    help='Estimate size of duplicated files by hashing a sample of size buckets')
+parser.add_argument('--sample', type=positive_int, default=100, metavar='N',
+                    help='Number of size buckets drawn in estimate mode')
+parser.add_argument('--estimates-file', default='estimates.json',
+                    help='File for estimates. The next full run shows how close the estimate was')
+parser.add_argument('--export-filter', metavar='FILE',
+                    help='Hash all found files and export Bloom filters of their digests and sizes to file')
+parser.add_argument('--check-filter', metavar='FILE',
+                    help='Find files that probably exist on another host using filter exported there')
+parser.add_argument('--fp-rate', type=probability, default=0.01, help='False positive rate of exported filter')
+parser.add_argument('--small-file-size', type=int, default=4096, metavar='BYTES',
+                    help='Files up to this size are compared by content in memory and hashed only if duplicated '
+                         '(0 - hash all files)')
+parser.add_argument('--small-file-workers', type=positive_int, default=8,
+                    help='Number of threads reading small files concurrently')
+parser.add_argument('--backend', choices=['local', 'object-store'], default='local',
+                    help='Storage backend. Object store is a stand-in that uses target directory as its bucket')
+parser.add_argument('--backend-latency', type=float, default=20, metavar='MS',
+                    help='Latency of every request to object store')
+parser.add_argument('--page-size', type=int, default=1000, help='Number of objects listed by one request')
+parser.add_argument('--range-size', type=int, default=8192, metavar='KB', help='Size of ranged reads from object store')
@@ -3,17 +3,62 @@
 
 import os
 import sys
+import bisect
+import errno
 import hashlib
+import heapq
+import itertools
+import tempfile
 import time
 import json
 import logging
+import math
+import mmap
+import pydoc
+import random
+import re
+import shutil
+import signal
+import socket
+import socketserver
+import stat
+import struct
+import tarfile
+import zipfile
+import threading
 import args_parser
+from array import array
+from collections import Counter
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 TARGET_DIR = r"C:\Program Files (x86)\Steam"
 BLOCK_SIZE = 65536
+ZERO_BLOCK = memoryview(bytes(BLOCK_SIZE))
+READAHEAD = 1048576
+SPARSE_UNSUPPORTED = (errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP)
+MAX_READ_RATE = 0
+MAX_OPEN_RATE = 0
+THROTTLE_INTERVAL = 1
+SMALL_FILE_SIZE = 4096
+SMALL_FILE_WORKERS = 8
+CALIBRATION_FILE = os.path.join(os.path.expanduser("~"), ".duplicates_calibration.json")
+CALIBRATION_ALGS = ["sha1", "sha256", "sha512", "md5"]
+CALIBRATION_BLOCK_SIZES = [65536, 262144, 1048576, 4194304]
+CALIBRATION_SAMPLE = 8
+CALIBRATION_BYTES = 4194304
 MAX_FILES = 10000
 PROCESSES = 2
 SIZE_UNIT = "MB"
@@ -22,6 +67,38 @@ LOG_FILE = "log.txt"
 QUIET = False
 VERBOSE = True
 DEFAULT_ALG = "sha1"
+JOURNAL_FILE = "journal.txt"
+JOURNAL_BATCH = 1000
+JOURNAL_SYNC_INTERVAL = 5
+TREE_CACHE_FILE = "tree_cache.json"
+ESTIMATES_FILE = "estimates.json"
+ESTIMATE_SAMPLE = 100
+ESTIMATE_Z = 1.96
+FILTER_FILE = "filter.bloom"
+FILTER_FP_RATE = 0.01
+DEDUPE_MODE = "auto"
+DEDUPE_JOURNAL_FILE = "dedupe_journal.txt"
+DEDUPE_BATCH = 100
+FICLONE = 0x40049409
+CHUNK_MIN_SIZE = 2048
+CHUNK_AVG_BITS = 13
+CHUNK_MAX_SIZE = 65536
+CHUNK_ALG = "sha1"
+CHUNK_PAIRS_MAX_FILES = 100
+CHUNK_PAIRS_SHOWN = 20
+ARCHIVE_SEPARATOR = "!/"
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+SOCKET_FILE = "duplicates.sock"
+MOUNTS_FILE = "/proc/mounts"
+WALKERS = 1
+WALK_QUEUE = 64
+MAX_MEMORY = 0
+RECORD_OVERHEAD = 150
+SORTER_FAN_IN = 64
+BACKEND = "local"
+BACKEND_LATENCY = 0.02
+PAGE_SIZE = 1000
+RANGE_SIZE = 8388608
 UNITS = {"KB": (1, "kilobytes"), "MB": (2, "megabytes"), "GB": (3, "gigabytes"), "TB":  (4, "terabytes")}
 
 logger = logging.getLogger("main")
@@ -46,151 +123,2188 @@ def measure_execution(section):
             self.timing[section] = round(time.time() - start, 1)
             return result
 
-        return wrapper
-    return outer_wrapper
+        return wrapper
+    return outer_wrapper
+
+
+class Statistics:
+    """
+    Accumulates statistics of check while stages are running,
+    so results could be produced without walking through found files again
+    """
+
+    def __init__(self):
+        self.files_count = 0
+        self.scanned_size = 0
+        self.hashed_count = 0
+        self.hashed_size = 0
+        self.duplicates_count = 0
+        self.duplicates_size = 0
+        self.replaced_count = 0
+        self.reclaimed_size = 0
+        self.histogram = dict([(size_class, 0) for size_class in self.get_size_classes()])
+
+    @staticmethod
+    def get_size_classes():
+        """
+        Get names of size classes in ascending order: 0 B, < 1 KB, < 1 MB, ..., >= 1 TB
+        """
+        return ['0 B'] + ['< 1 {}'.format(unit) for unit in UNITS] + ['>= 1 {}'.format(list(UNITS)[-1])]
+
+    @staticmethod
+    def get_size_class(f_size):
+        """
+        Get name of size class for file size
+        """
+        if not f_size:
+            return '0 B'
+
+        for unit, (degree, _) in UNITS.items():
+            if f_size < 1024 ** degree:
+                return '< 1 {}'.format(unit)
+
+        return '>= 1 {}'.format(list(UNITS)[-1])
+
+    def add_scanned(self, f_size):
+        self.files_count += 1
+        self.scanned_size += f_size
+        self.histogram[self.get_size_class(f_size)] += 1
+
+    def add_hashed(self, f_size):
+        self.hashed_count += 1
+        self.hashed_size += f_size
+
+    def add_duplicates(self, f_size, n_paths):
+        self.duplicates_count += n_paths - 1
+        self.duplicates_size += (n_paths - 1) * f_size
+
+    def get_histogram(self):
+        """
+        Get number of scanned files per size class. Empty classes are skipped
+        """
+        return dict([(size_class, count) for size_class, count in self.histogram.items() if count])
+
+
+class SizeSorter:
+    """
+    External-memory sorting of file records by size. Records are kept in memory until limit is reached,
+    then they are sorted and spilled to run file on local scratch. Runs are merged by size with k-way merge,
+    in several passes if there are more runs than files which could be opened at once
+    """
+
+    def __init__(self, max_memory=MAX_MEMORY, scratch_dir=None, fan_in=SORTER_FAN_IN):
+        self.max_memory = max_memory * 1024 ** 2
+        self.scratch_dir = scratch_dir
+        self.fan_in = fan_in
+        self.records = []
+        self.memory = 0
+        self.runs = []
+
+    def add(self, f_path, f_size):
+        """
+        Add record to memory. Spill records to run file if memory limit is reached
+        """
+        self.records.append((f_size, f_path))
+        self.memory += RECORD_OVERHEAD + len(f_path)
+        if self.memory >= self.max_memory:
+            self.spill()
+
+    def spill(self):
+        """
+        Sort records in memory and write them to new run file
+        """
+        self.records.sort()
+        run = self.write_run(self.records)
+        logger.debug(msg='Spill {} records to {}'.format(len(self.records), run))
+        self.runs.append(run)
+        self.records = []
+        self.memory = 0
+
+    def write_run(self, records):
+        """
+        Write sorted records to new run file. Returns name of run file
+        """
+        with tempfile.NamedTemporaryFile('w', dir=self.scratch_dir, prefix='duplicates_run_', suffix='.txt',
+                                         delete=False) as run_file:
+            for record in records:
+                run_file.write(json.dumps(record) + '\n')
+
+        return run_file.name
+
+    @staticmethod
+    def read_run(run):
+        with open(run, 'r') as run_file:
+            for line in run_file:
+                yield tuple(json.loads(line))
+
+    def reduce_runs(self):
+        """
+        Merge runs by groups of fan_in runs to new runs, till all runs could be opened at once
+        """
+        while len(self.runs) > self.fan_in:
+            runs, self.runs = self.runs[:self.fan_in], self.runs[self.fan_in:]
+            self.runs.append(self.write_run(heapq.merge(*[self.read_run(run) for run in runs])))
+            logger.debug(msg='Merge {} runs to {}'.format(len(runs), self.runs[-1]))
+
+            for run in runs:
+                try:
+                    os.remove(run)
+                except (OSError, PermissionError) as e:
+                    logger.error(msg=e)
+
+    def merge(self):
+        """
+        Merge sorted runs and records left in memory. Returns iterator of records sorted by size
+        """
+        self.reduce_runs()
+        self.records.sort()
+        return heapq.merge(self.records, *[self.read_run(run) for run in self.runs])
+
+    def find_equal_sizes(self):
+        """
+        Get groups of files with equal size one by one. Groups with single file are skipped
+        """
+        for f_size, records in itertools.groupby(self.merge(), key=lambda record: record[0]):
+            f_paths = [f_path for _, f_path in records]
+            if len(f_paths) > 1:
+                yield f_size, f_paths
+
+    def close(self):
+        """
+        Delete run files and forget records
+        """
+        for run in self.runs:
+            try:
+                os.remove(run)
+            except (OSError, PermissionError) as e:
+                logger.error(msg=e)
+
+        self.records = []
+        self.memory = 0
+        self.runs = []
+
+
+class ColumnarIndex:
+    """
+    Columnar storage of found files: paths in list, sizes, devices and inodes in typed arrays.
+    Same-size groups and hardlinks are found with NumPy if it is installed, otherwise with dicts
+    """
+
+    # Archive members have no inode, every member gets its own fake one on this device
+    NO_DEVICE = 2 ** 64 - 1
+
+    def __init__(self):
+        self.paths = []
+        self.sizes = array('q')
+        self.devices = array('Q')
+        self.inodes = array('Q')
+
+    def add(self, f_path, f_size, f_id=None):
+        """
+        Add file to index. File id is pair of device and inode
+        """
+        device, inode = f_id if f_id else (self.NO_DEVICE, len(self.paths))
+        self.paths.append(f_path)
+        self.sizes.append(f_size)
+        self.devices.append(device)
+        self.inodes.append(inode)
+
+    def find_candidates(self):
+        """
+        Get sorted list of files which should be hashed: files with equal size,
+        only the first path of every hardlinked file is taken
+        """
+        if not self.paths:
+            return []
+
+        if numpy:
+            candidates = self.find_candidates_numpy()
+        else:
+            candidates = self.find_candidates_python()
+
+        return sorted([self.paths[index] for index in candidates])
+
+    def find_candidates_numpy(self):
+        sizes = numpy.frombuffer(self.sizes, dtype=numpy.int64)
+        devices = numpy.frombuffer(self.devices, dtype=numpy.uint64)
+        inodes = numpy.frombuffer(self.inodes, dtype=numpy.uint64)
+
+        # Collapse hardlinks: stable sort by (device, inode) and keep the first index of every pair
+        order = numpy.lexsort((inodes, devices))
+        devices, inodes = devices[order], inodes[order]
+        first = numpy.ones(len(order), dtype=bool)
+        first[1:] = (devices[1:] != devices[:-1]) | (inodes[1:] != inodes[:-1])
+        unique_files = order[first]
+
+        _, inverse, counts = numpy.unique(sizes[unique_files], return_inverse=True, return_counts=True)
+        return unique_files[counts[inverse] > 1].tolist()
+
+    def find_candidates_python(self):
+        unique_files = {}
+        for index, f_id in enumerate(zip(self.devices, self.inodes)):
+            unique_files.setdefault(f_id, index)
+
+        groups = {}
+        for index in unique_files.values():
+            groups.setdefault(self.sizes[index], []).append(index)
+
+        return [index for group in groups.values() if len(group) > 1 for index in group]
+
+
+class LocalBackend:
+    """
+    Storage backend for local filesystem. Directories are walked by walker of Files class with all its options,
+    regular files are listed in pages with one stat call per file. Reads are sparse-aware and could be cache-polite
+    """
+
+    paged = False
+
+    def __init__(self, page_size=PAGE_SIZE):
+        self.page_size = page_size
+
+    @staticmethod
+    def walk(top, followlinks=False):
+        return os.walk(top=top, followlinks=followlinks)
+
+    def list_pages(self, top, walk=None, page_size=None):
+        """
+        List regular files of directory tree as pages of (path, size, (device, inode)).
+        Tree is walked by given walk, by os.walk by default
+        """
+        if not page_size:
+            page_size = self.page_size
+        if walk is None:
+            walk = self.walk(top)
+
+        page = []
+        for current_dir, _, included_files in walk:
+            for f in included_files:
+                f_path = os.path.join(current_dir, f)
+                try:
+                    f_stat = self.stat(f_path)
+                except OSError:
+                    continue
+
+                if stat.S_ISREG(f_stat.st_mode):
+                    page.append((f_path, f_stat.st_size, (f_stat.st_dev, f_stat.st_ino)))
+                if len(page) >= page_size:
+                    yield page
+                    page = []
+        if page:
+            yield page
+
+    @staticmethod
+    def stat(f_path):
+        return os.stat(f_path)
+
+    @staticmethod
+    def read_range(f_path, offset, length):
+        """
+        Read range of file with one read call. File is not buffered, so there is only one read syscall
+        """
+        with open(f_path, 'rb', buffering=0) as f_file:
+            f_file.seek(offset)
+            return f_file.read(length)
+
+    @staticmethod
+    def read_blocks(f_path, block_size=BLOCK_SIZE, throttle=None, cache_polite=False, readahead=READAHEAD):
+        with open(f_path, 'rb') as f_file:
+            yield from Hashes.read_blocks(f_file, block_size=block_size, cache_polite=cache_polite,
+                                          readahead=readahead, throttle=throttle)
+
+
+class ObjectStoreBackend:
+    """
+    Stand-in for object storage backed by local directory. Every request waits for latency, like a request
+    to remote bucket. Objects are listed by key in pages and read by ranges, so number of requests stays low
+    """
+
+    paged = True
+
+    def __init__(self, root, latency=BACKEND_LATENCY, page_size=PAGE_SIZE, range_size=RANGE_SIZE):
+        self.root = root
+        self.latency = latency
+        self.page_size = page_size
+        self.range_size = range_size
+        self.objects = None
+        self.requests = Counter()
+        self.lock = threading.Lock()
+
+    def request(self, kind):
+        with self.lock:
+            self.requests[kind] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get_key(self, f_path):
+        return os.path.relpath(f_path, self.root).replace(os.sep, '/')
+
+    def get_objects(self):
+        """
+        Get sorted index of objects in bucket. It is built once, as object storage keeps it on its side
+        """
+        if self.objects is None:
+            objects = []
+            for current_dir, _, included_files in os.walk(self.root):
+                for f in included_files:
+                    f_path = os.path.join(current_dir, f)
+                    if os.path.isfile(f_path):
+                        objects.append((self.get_key(f_path), os.path.getsize(f_path)))
+            objects.sort()
+            self.objects = objects
+        return self.objects
+
+    def list_page(self, prefix='', start_after='', page_size=None):
+        """
+        List one page of objects with keys after start_after. Returns page and key to continue from,
+        which is None on the last page
+        """
+        if not page_size:
+            page_size = self.page_size
+        self.request('list')
+
+        objects = self.get_objects()
+        start = bisect.bisect_right(objects, (start_after, float('inf'))) if start_after else 0
+        start = max(start, bisect.bisect_left(objects, (prefix,)))
+        page = []
+        for key, f_size in objects[start:start + page_size]:
+            if not key.startswith(prefix):
+                break
+            page.append((key, f_size))
+
+        end = start + page_size
+        more = len(page) == page_size and end < len(objects) and objects[end][0].startswith(prefix)
+        return page, page[-1][0] if more else None
+
+    def list_pages(self, top, walk=None, page_size=None):
+        """
+        List all objects under directory as pages of (path, size, None). Objects are listed by key,
+        so walk is not used. Objects have no inodes, so there are no hardlinks to collapse
+        """
+        prefix = self.get_key(top)
+        prefix = '' if prefix == '.' else prefix + '/'
+        page, start_after = self.list_page(prefix=prefix, page_size=page_size)
+        while page:
+            yield [(os.path.join(self.root, *key.split('/')), f_size, None) for key, f_size in page]
+            if not start_after:
+                break
+            page, start_after = self.list_page(prefix=prefix, start_after=start_after, page_size=page_size)
+
+    def stat(self, f_path):
+        """
+        Get size and modification time of object with head request
+        """
+        self.request('head')
+        return os.stat(f_path)
+
+    def read_range(self, f_path, offset, length):
+        self.request('get')
+        with open(f_path, 'rb') as f_file:
+            f_file.seek(offset)
+            return f_file.read(length)
+
+    def read_blocks(self, f_path, block_size=BLOCK_SIZE, throttle=None, **kwargs):
+        """
+        Read object by ranged requests and split every range to blocks
+        """
+        offset = 0
+        while True:
+            data = self.read_range(f_path, offset, max(self.range_size, block_size))
+            if throttle:
+                throttle.read(len(data))
+            for start in range(0, len(data), block_size):
+                yield data[start:start + block_size]
+
+            offset += len(data)
+            if len(data) < max(self.range_size, block_size):
+                break
+
+
+class Files:
+    """
+    This class works with filesystem
+    """
+
+    def __init__(self, top_dir=TARGET_DIR, max_files=MAX_FILES, stats=None, archives=False,
+                 max_memory=MAX_MEMORY, scratch_dir=None, columnar=False, one_filesystem=False,
+                 exclude_fstypes=None, follow_links=False, walkers=WALKERS, walk_queue=WALK_QUEUE, backend=None):
+        self.top_dir = top_dir
+        self.backend = backend if backend else LocalBackend()
+        self.walkers = walkers
+        self.walk_queue = walk_queue
+        self.max_files = max_files
+        self.one_filesystem = one_filesystem
+        self.exclude_fstypes = exclude_fstypes if exclude_fstypes else []
+        self.follow_links = follow_links
+        self.stats = stats if stats else Statistics()
+        self.archives = archives
+        self.sorter = SizeSorter(max_memory=max_memory, scratch_dir=scratch_dir) if max_memory else None
+        self.columns = ColumnarIndex() if columnar and not self.sorter else None
+
+    def find(self, top=None, max_files=None):
+        """
+        Find all files in directory. Limited by max_files.
+        In external-memory and columnar modes records are passed to sorter or columnar index
+        and returned dict is empty
+        """
+        if not top:
+            top = self.top_dir
+        if not max_files:
+            max_files = self.max_files
+
+        files = {}
+        counter = 0
+        page_size = min(self.backend.page_size, max_files)
+
+        try:
+            # Files are listed by storage backend page by page. Local directories are walked by walker with all options
+            for page in self.backend.list_pages(top, walk=self.walk_dirs(top), page_size=page_size):
+                for f_path, f_size, f_id in page:
+                    # Device and inode are used only to collapse hardlinks in columnar index
+                    self.add_file(files, f_path, f_size, f_id=f_id)
+                    counter += 1
+
+                    # Archive members are checked as separate files
+                    if self.archives and self.is_archive(f_path):
+                        for member_path, member_size in self.get_archive_members(f_path):
+                            if counter >= max_files: break
+                            self.add_file(files, member_path, member_size)
+                            counter += 1
+
+                    if counter >= max_files: break
+                if counter >= max_files: break
+
+        except (OSError, PermissionError) as e:
+            logger.error(msg=e)
+
+        return files
+
+    def walk_dirs(self, top):
+        """
+        Walk directory tree and leave only directories which should be walked.
+        Directories are identified by device and inode, so bind mounts and symlinked trees are walked once
+        """
+        top_stat = self.get_file_stat(top)
+        visited = {(top_stat.st_dev, top_stat.st_ino)} if top_stat else set()
+        mounts = self.get_mounts() if self.exclude_fstypes else {}
+
+        for current_dir, included_dirs, included_files in self.walk(top):
+            included_dirs[:] = self.filter_dirs(current_dir, included_dirs, top_stat, visited, mounts)
+            yield current_dir, included_dirs, included_files
+
+    def walk(self, top):
+        """
+        Walk directory tree with walk of storage backend or with concurrent walker if there are several workers
+        """
+        if self.walkers > 1:
+            return self.walk_concurrently(top)
+        return self.backend.walk(top, followlinks=self.follow_links)
+
+    @staticmethod
+    def list_dir(d_path):
+        """
+        List directory in the same way as os.walk does. Returns None if directory can't be listed
+        """
+        dirs, files = [], []
+        try:
+            with os.scandir(d_path) as entries:
+                for entry in entries:
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    (dirs if is_dir else files).append(entry.name)
+
+        except OSError as e:
+            logger.error(msg=e)
+            return None
+
+        return dirs, files
+
+    def walk_concurrently(self, top):
+        """
+        Walk directory tree top-down in exactly the same order as os.walk, while directories
+        which will be walked next are listed concurrently by pool of workers.
+        Number of directories listed ahead is bounded by walk queue
+        """
+        executor = ThreadPoolExecutor(max_workers=self.walkers)
+        # The last item is the next directory to walk: [path, listing future]
+        stack = [[top, None]]
+
+        try:
+            while stack:
+                for item in stack[-self.walk_queue:]:
+                    if not item[1]:
+                        item[1] = executor.submit(self.list_dir, item[0])
+
+                d_path, listing = stack.pop()
+                listing = listing.result()
+                if listing is None:
+                    continue
+
+                dirs, files = listing
+                yield d_path, dirs, files
+
+                # Like os.walk, walk only dirs left by caller
+                for d in reversed(dirs):
+                    new_path = os.path.join(d_path, d)
+                    if self.follow_links or not os.path.islink(new_path):
+                        stack.append([new_path, None])
+
+        finally:
+            for _, listing in stack:
+                if listing:
+                    listing.cancel()
+            executor.shutdown(wait=True)
+
+    def filter_dirs(self, current_dir, included_dirs, top_stat, visited, mounts):
+        """
+        Get directories which should be walked: not visited yet, on the same filesystem as top directory
+        in one-filesystem mode and not mount points of excluded filesystem types
+        """
+        dirs = []
+        for d in included_dirs:
+            d_path = os.path.join(current_dir, d)
+
+            # Symlinked directories are not walked without follow_links, so they are not visited
+            if not self.follow_links and os.path.islink(d_path):
+                dirs.append(d)
+                continue
+
+            d_stat = self.get_file_stat(d_path)
+            if not d_stat:
+                continue
+
+            if self.one_filesystem and top_stat and d_stat.st_dev != top_stat.st_dev:
+                logger.info(msg='Skip directory on other filesystem: {}'.format(d_path))
+                continue
+
+            if mounts and mounts.get(os.path.realpath(d_path)) in self.exclude_fstypes:
+                logger.info(msg='Skip mount point of excluded filesystem type: {}'.format(d_path))
+                continue
+
+            if (d_stat.st_dev, d_stat.st_ino) in visited:
+                logger.info(msg='Skip already visited directory: {}'.format(d_path))
+                continue
+
+            visited.add((d_stat.st_dev, d_stat.st_ino))
+            dirs.append(d)
+
+        return dirs
+
+    @staticmethod
+    def get_mounts(mounts_file=MOUNTS_FILE):
+        """
+        Get dict {mount point: filesystem type}. Returns empty dict if mounts are unknown on this platform
+        """
+        mounts = {}
+        try:
+            with open(mounts_file, 'r') as f_mounts:
+                for line in f_mounts:
+                    fields = line.split()
+                    if len(fields) >= 3:
+                        # Spaces and other special chars in mount points are escaped with octal codes
+                        mount_point = re.sub(r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), fields[1])
+                        mounts[mount_point] = fields[2]
+
+        except (OSError, PermissionError) as e:
+            logger.error(msg=e)
+
+        return mounts
+
+    def add_file(self, files, f_path, f_size, f_id=None):
+        """
+        Add found file to dict, to sorter in external-memory mode or to columnar index
+        """
+        if self.sorter:
+            self.sorter.add(f_path, f_size)
+        elif self.columns:
+            self.columns.add(f_path, f_size, f_id=f_id)
+        else:
+            files.update({f_path: {"f_size": f_size}})
+        self.stats.add_scanned(f_size)
+
+    def iter_equal_files(self):
+        """
+        Get files with equal size from sorter, bucket by bucket, without keeping all records in memory.
+        Runs are kept till close, because later stages could read all records again
+        """
+        for _, f_paths in self.sorter.find_equal_sizes():
+            for f_path in f_paths:
+                yield f_path
+
+    def close(self):
+        """
+        Delete run files of sorter
+        """
+        if self.sorter:
+            self.sorter.close()
+
+    def find_equal_files(self, files):
+        """
+        Get list of files with equal size
+        """
+        equal_files = []
+        file_sizes = Counter(self.get_files_sizes(files))
+
+        for f_path, f_meta in files.items():
+            if f_meta and f_meta.get('f_size') is not None and file_sizes[f_meta['f_size']] > 1:
+                equal_files.append(f_path)
+
+        equal_files.sort()
+        return equal_files
+
+    @staticmethod
+    def is_archive(f_path):
+        return f_path.lower().endswith(ARCHIVE_EXTENSIONS)
+
+    @staticmethod
+    def get_archive_members(f_path):
+        """
+        Get list of regular files in zip or tar archive with their uncompressed sizes.
+        Path of member is path of archive and name of member joined by separator
+        """
+        members = []
+
+        try:
+            if f_path.lower().endswith('.zip'):
+                with zipfile.ZipFile(f_path) as archive:
+                    for info in archive.infolist():
+                        if not info.is_dir():
+                            members.append((f_path + ARCHIVE_SEPARATOR + info.filename, info.file_size))
+            else:
+                with tarfile.open(f_path, mode='r|*') as archive:
+                    for info in archive:
+                        if info.isfile():
+                            members.append((f_path + ARCHIVE_SEPARATOR + info.name, info.size))
+
+        except (OSError, PermissionError, zipfile.BadZipFile, tarfile.TarError) as e:
+            logger.error(msg='{}: {}'.format(f_path, e))
+
+        return members
+
+    @staticmethod
+    def split_archive_path(f_path):
+        """
+        Split path of archive member to path of archive and name of member. Returns None for regular files
+        """
+        index = f_path.find(ARCHIVE_SEPARATOR)
+        while index >= 0:
+            archive = f_path[:index]
+            if Files.is_archive(archive) and os.path.isfile(archive):
+                return archive, f_path[index + len(ARCHIVE_SEPARATOR):]
+            index = f_path.find(ARCHIVE_SEPARATOR, index + 1)
+
+        return None
+
+    @staticmethod
+    def get_file_stat(f_path):
+        try:
+            return os.stat(f_path)
+        except OSError as e:
+            logger.error(msg=e)
+            return None
+
+    def get_file_size(self, f_path):
+        try:
+            return self.backend.stat(f_path).st_size
+        except OSError as e:
+            logger.error(msg=e)
+            return 0
+
+    @staticmethod
+    def get_files_sizes(files):
+        """
+        Get list with sizes of all checked files
+        """
+        file_sizes = []
+        for f_meta in files.values():
+            if f_meta and f_meta.get("f_size") is not None:
+                file_sizes.append(int(f_meta["f_size"]))
+
+        file_sizes.sort()
+        return file_sizes
+
+    @staticmethod
+    def write_dict_to_file(results, filename):
+        """
+        Write dictionary with results to output file
+        """
+        try:
+            with open(filename, 'a+') as results_file:
+                json.dump(results, results_file)
+                results_file.write("\n")
+
+        except (OSError, PermissionError) as e:
+            logger.info(msg=e)
+
+
+class Journal:
+    """
+    Append-only journal with one json entry per line.
+    Entries are written in batches and file is synced to disk on interval
+    """
+
+    def __init__(self, filename=JOURNAL_FILE, batch_size=JOURNAL_BATCH, sync_interval=JOURNAL_SYNC_INTERVAL):
+        self.filename = filename
+        self.batch_size = batch_size
+        self.sync_interval = sync_interval
+        self.entries = []
+        self.synced = time.time()
+        self.journal_file = None
+        self.lock = threading.Lock()
+
+    def add(self, entry):
+        """
+        Add entry to batch. Write batch if it is full or sync interval is over
+        """
+        with self.lock:
+            self.entries.append(entry)
+            if len(self.entries) >= self.batch_size or time.time() - self.synced >= self.sync_interval:
+                self._write_entries()
+
+    def flush(self):
+        with self.lock:
+            self._write_entries()
+
+    def close(self):
+        with self.lock:
+            self._write_entries()
+            if self.journal_file:
+                self.journal_file.close()
+                self.journal_file = None
+
+    def _write_entries(self):
+        """
+        Append batch to journal file and sync it to disk
+        """
+        if self.entries:
+            try:
+                if not self.journal_file:
+                    self.journal_file = open(self.filename, 'a')
+                self.journal_file.write(''.join([json.dumps(entry) + '\n' for entry in self.entries]))
+                self.journal_file.flush()
+                os.fsync(self.journal_file.fileno())
+
+            except (OSError, PermissionError) as e:
+                logger.error(msg=e)
+
+        self.entries = []
+        self.synced = time.time()
+
+    def replay(self):
+        """
+        Read all entries from journal file. Broken lines (e.g. interrupted write) are skipped
+        """
+        entries = []
+        if not os.path.isfile(self.filename):
+            return entries
+
+        try:
+            with open(self.filename, 'r') as journal_file:
+                for line in journal_file:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        logger.warning(msg='Skip broken journal entry: {}'.format(line.strip()))
+
+        except (OSError, PermissionError) as e:
+            logger.error(msg=e)
+
+        return entries
+
+
+class Chunker:
+    """
+    Splits stream of bytes into content-defined chunks using gear rolling hash.
+    Boundary is found where high bits of fingerprint are zero, so equal content gives equal chunks
+    regardless of its offset in file
+    """
+
+    # Random 64-bit value for every byte, the same on every run
+    GEAR = [int.from_bytes(hashlib.sha1(bytes([byte])).digest()[:8], 'little') for byte in range(256)]
+    WINDOW = 64
+
+    def __init__(self, min_size=CHUNK_MIN_SIZE, avg_bits=CHUNK_AVG_BITS, max_size=CHUNK_MAX_SIZE, alg=CHUNK_ALG):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.mask = ((1 << avg_bits) - 1) << (self.WINDOW - avg_bits)
+        self.alg = alg
+        self.hasher = hashlib.new(alg)
+        self.fingerprint = 0
+        self.length = 0
+        self.chunks = []
+
+    def update(self, buf):
+        """
+        Feed next block of file. Chunk can continue in the next block
+        """
+        gear, mask, fingerprint, length = self.GEAR, self.mask, self.fingerprint, self.length
+        buf = memoryview(buf)
+        start, pos, end = 0, 0, len(buf)
+
+        while pos < end:
+            # Boundary can't be before min size and fingerprint depends only on last 64 bytes
+            skip = self.min_size - self.WINDOW - length
+            if skip > 0:
+                step = min(skip, end - pos)
+                pos += step
+                length += step
+                continue
+
+            fingerprint = ((fingerprint << 1) + gear[buf[pos]]) & 0xFFFFFFFFFFFFFFFF
+            pos += 1
+            length += 1
+
+            if (length >= self.min_size and not fingerprint & mask) or length >= self.max_size:
+                self.hasher.update(buf[start:pos])
+                self.chunks.append((self.hasher.hexdigest(), length))
+                self.hasher = hashlib.new(self.alg)
+                start, fingerprint, length = pos, 0, 0
+
+        self.hasher.update(buf[start:])
+        self.fingerprint, self.length = fingerprint, length
+
+    def finish(self):
+        """
+        Close the last chunk and return list of chunks (digest, size)
+        """
+        if self.length:
+            self.chunks.append((self.hasher.hexdigest(), self.length))
+            self.hasher = hashlib.new(self.alg)
+            self.fingerprint, self.length = 0, 0
+        return self.chunks
+
+
+class ChunkIndex:
+    """
+    Index of content-defined chunks of hashed files. Used to measure partial (block-level) duplication
+    """
+
+    def __init__(self, min_size=CHUNK_MIN_SIZE, avg_bits=CHUNK_AVG_BITS, max_size=CHUNK_MAX_SIZE):
+        self.min_size = min_size
+        self.avg_bits = avg_bits
+        self.max_size = max_size
+        self.chunks = {}
+        self.lock = threading.Lock()
+
+    def get_chunker(self):
+        return Chunker(min_size=self.min_size, avg_bits=self.avg_bits, max_size=self.max_size)
+
+    def add_file(self, f_path, chunks):
+        """
+        Add chunks of file to index. Chunk index stores size of chunk and number of its copies in every file
+        """
+        with self.lock:
+            for digest, size in chunks:
+                if digest not in self.chunks:
+                    self.chunks[digest] = {'size': size, 'f_paths': {}}
+                f_paths = self.chunks[digest]['f_paths']
+                f_paths[f_path] = f_paths.get(f_path, 0) + 1
+
+    def get_shared_size(self):
+        """
+        Get number of bytes that could be saved if every chunk is stored only once
+        """
+        return sum([c_meta['size'] * (sum(c_meta['f_paths'].values()) - 1) for c_meta in self.chunks.values()])
+
+    def get_shared_pairs(self, max_files=CHUNK_PAIRS_MAX_FILES):
+        """
+        Get number of bytes shared by every pair of files, sorted from the biggest one.
+        Chunks that are in more than max_files files (e.g. zero blocks) are skipped to keep number of pairs sane
+        """
+        pairs = {}
+        for c_meta in self.chunks.values():
+            f_paths = sorted(c_meta['f_paths'].items())
+            if len(f_paths) < 2 or len(f_paths) > max_files:
+                continue
+
+            for i, (f_path, count) in enumerate(f_paths):
+                for other_path, other_count in f_paths[i + 1:]:
+                    pair = (f_path, other_path)
+                    pairs[pair] = pairs.get(pair, 0) + c_meta['size'] * min(count, other_count)
+
+        return sorted(pairs.items(), key=lambda item: (-item[1], item[0]))
+
+
+class Throttle:
+    """
+    Token buckets limiting rate of read bytes and opened files. Buckets are shared by all readers,
+    so they are thread-safe. Rates could be changed at runtime in control file, which is checked
+    once per interval or immediately after SIGUSR1
+    """
+
+    def __init__(self, read_rate=MAX_READ_RATE, open_rate=MAX_OPEN_RATE, control_file=None,
+                 interval=THROTTLE_INTERVAL):
+        self.rates = {'read': read_rate, 'open': open_rate}
+        self.tokens = {'read': read_rate, 'open': open_rate}
+        self.updated = {'read': time.monotonic(), 'open': time.monotonic()}
+        self.control_file = control_file
+        self.control_mtime = None
+        self.interval = interval
+        self.checked = 0
+        self.lock = threading.Lock()
+
+    def set_rates(self, read_rate=None, open_rate=None):
+        """
+        Change rates in bytes and files per second, 0 means no limit. Tokens over new rate are dropped
+        """
+        with self.lock:
+            for kind, rate in (('read', read_rate), ('open', open_rate)):
+                if rate is not None:
+                    self.rates[kind] = rate
+                    self.tokens[kind] = min(self.tokens[kind], rate)
+                    self.updated[kind] = time.monotonic()
+
+    def check_control(self):
+        """
+        Re-read control file if it was modified. File has the same rates as console args:
+        {"max_read_rate": MB per second, "max_open_rate": files per second}
+        """
+        if not self.control_file or time.monotonic() - self.checked < self.interval:
+            return
+        self.checked = time.monotonic()
+
+        try:
+            mtime = os.stat(self.control_file).st_mtime_ns
+            if mtime == self.control_mtime:
+                return
+            with open(self.control_file, 'r') as control_file:
+                control = json.load(control_file)
+            self.control_mtime = mtime
+
+        except FileNotFoundError:
+            return
+        except (OSError, PermissionError, ValueError) as e:
+            logger.error(msg=e)
+            return
+
+        if not isinstance(control, dict) or not all([self.is_rate(control.get(key))
+                                                     for key in ('max_read_rate', 'max_open_rate')]):
+            logger.error(msg='Wrong rates in control file {}, keep current rates: {}'.format(self.control_file,
+                                                                                            control))
+            return
+
+        read_rate = control.get('max_read_rate')
+        self.set_rates(read_rate=read_rate * 1024 ** 2 if read_rate is not None else None,
+                       open_rate=control.get('max_open_rate'))
+        logger.info(msg='Throttle rates: {} bytes/sec, {} files/sec'.format(self.rates['read'], self.rates['open']))
+
+    @staticmethod
+    def is_rate(rate):
+        """
+        Rate from control file is optional, otherwise it's a finite non-negative number
+        """
+        if rate is None:
+            return True
+        return isinstance(rate, (int, float)) and not isinstance(rate, bool) and math.isfinite(rate) and rate >= 0
+
+    def handle_signal(self, signum, frame):
+        self.checked = 0
+
+    def acquire(self, kind, amount):
+        """
+        Take tokens from bucket. Bucket holds tokens for one second, when it is empty reader waits
+        till tokens are refilled. Tokens are taken in debt, so the next reader waits for this one too
+        """
+        self.check_control()
+
+        with self.lock:
+            rate = self.rates[kind]
+            if not rate:
+                return
+            now = time.monotonic()
+            self.tokens[kind] = min(rate, self.tokens[kind] + (now - self.updated[kind]) * rate)
+            self.updated[kind] = now
+            self.tokens[kind] -= amount
+            delay = -self.tokens[kind] / rate
+
+        if delay > 0:
+            time.sleep(delay)
+
+    def read(self, n_bytes):
+        self.acquire('read', n_bytes)
+
+    def open(self):
+        self.acquire('open', 1)
+
+
+class Hashes:
+    """
+    Class calculates hashes for files and for stores them
+    """
+
+    def __init__(self, alg=DEFAULT_ALG, journal=None, stats=None, chunk_index=None,
+                 cache_polite=False, readahead=READAHEAD, block_size=BLOCK_SIZE, throttle=None, extra_algs=None,
+                 small_file_size=SMALL_FILE_SIZE, small_file_workers=SMALL_FILE_WORKERS, backend=None):
+        self.alg = alg
+        self.backend = backend if backend else LocalBackend()
+        self.extra_algs = extra_algs if extra_algs else []
+        self.digests = {}
+        self.block_size = block_size
+        self.journal = journal
+        self.stats = stats if stats else Statistics()
+        self.chunk_index = chunk_index
+        self.cache_polite = cache_polite
+        self.readahead = readahead
+        self.throttle = throttle
+        self.small_file_size = small_file_size
+        self.small_file_workers = small_file_workers
+        self.finished = {}
+
+    def get_hash_of_file(self, f_path, alg=None):
+        """
+        Read file from storage backend, calculate hash of file and return it if it exists
+        """
+        try:
+            if self.throttle:
+                self.throttle.open()
+            blocks = self.backend.read_blocks(f_path, block_size=self.block_size, throttle=self.throttle,
+                                              cache_polite=self.cache_polite, readahead=self.readahead)
+            return self.get_hash_of_blocks(blocks, f_path=f_path, alg=alg)
+
+        except (PermissionError, OSError) as e:
+            logger.error(msg=e)
+            return None
+
+    @staticmethod
+    def read_stream(f_file, block_size=BLOCK_SIZE, throttle=None):
+        """
+        Read file object block by block till the end
+        """
+        for buf in iter(lambda: f_file.read(block_size), b''):
+            if throttle:
+                throttle.read(len(buf))
+            yield buf
+
+    @staticmethod
+    def seek_data(fd, offset, f_size):
+        """
+        Get offset of the next data extent. If there is no data after offset, the rest of file is a hole.
+        Returns None if filesystem does not support SEEK_DATA
+        """
+        try:
+            return min(os.lseek(fd, offset, os.SEEK_DATA), f_size)
+        except OSError as e:
+            if e.errno in SPARSE_UNSUPPORTED:
+                return None
+            if e.errno != errno.ENXIO:
+                raise
+            return f_size
+
+    @staticmethod
+    def read_blocks(f_file, block_size=BLOCK_SIZE, cache_polite=False, readahead=READAHEAD, throttle=None):
+        """
+        Read file block by block. Data extents are found with SEEK_DATA/SEEK_HOLE,
+        holes of sparse file are not read from disk and returned as zero blocks.
+        Bytes are the same as for dense read, so the hash is the same too. Only bytes read from disk are throttled.
+        If filesystem does not support SEEK_DATA, file is read densely.
+        In cache-polite mode kernel is asked to read ahead explicitly and to drop every block
+        from page cache once it is hashed
+        """
+        fd = f_file.fileno()
+        f_size = os.fstat(fd).st_size
+        sparse = hasattr(os, 'SEEK_DATA')
+        cache_polite = cache_polite and hasattr(os, 'posix_fadvise')
+        offset, ahead = 0, 0
+
+        if cache_polite:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+        while offset < f_size:
+            data = Hashes.seek_data(fd, offset, f_size) if sparse else offset
+            if data is None:
+                sparse, data = False, offset
+            while offset < data:
+                zeros = ZERO_BLOCK[:min(block_size, data - offset, len(ZERO_BLOCK))]
+                offset += len(zeros)
+                yield zeros
+
+            if offset >= f_size:
+                break
+
+            hole = min(os.lseek(fd, data, os.SEEK_HOLE), f_size) if sparse else f_size
+            f_file.seek(data)
+            while offset < hole:
+                if cache_polite and readahead and offset >= ahead:
+                    os.posix_fadvise(fd, offset, readahead, os.POSIX_FADV_WILLNEED)
+                    ahead = offset + readahead
+
+                buf = f_file.read(min(block_size, hole - offset))
+                if not buf:
+                    return
+                if throttle:
+                    throttle.read(len(buf))
+                yield buf
+
+                if cache_polite:
+                    os.posix_fadvise(fd, offset, len(buf), os.POSIX_FADV_DONTNEED)
+                offset += len(buf)
+
+        # File could grow while it was read
+        f_file.seek(offset)
+        yield from Hashes.read_stream(f_file, block_size, throttle=throttle)
+
+    def get_hash_of_blocks(self, blocks, f_path, alg=None):
+        """
+        Calculate hash of file from its blocks. Chunks are indexed and digests of extra algorithms
+        are calculated in the same pass, all digests of file are stored in digests dict
+        """
+        if not alg:
+            alg = self.alg
+        hasher = getattr(hashlib, alg, hashlib.sha1)()
+        extra_hashers = [(extra_alg, hashlib.new(extra_alg)) for extra_alg in self.extra_algs if extra_alg != alg]
+        chunker = self.chunk_index.get_chunker() if self.chunk_index else None
+        n_bytes = 0
+
+        for buf in blocks:
+            hasher.update(buf)
+            for _, extra_hasher in extra_hashers:
+                extra_hasher.update(buf)
+            if chunker:
+                chunker.update(buf)
+            n_bytes += len(buf)
+
+        if chunker:
+            self.chunk_index.add_file(f_path, chunker.finish())
+        if extra_hashers:
+            hashers = [(alg, hasher)] + extra_hashers
+            self.digests[f_path] = dict([(hasher_alg, f_hasher.hexdigest()) for hasher_alg, f_hasher in hashers])
+        self.stats.add_hashed(n_bytes)
+        return hasher.hexdigest()
+
+    def get_hashes_of_members(self, archive, members):
+        """
+        Calculate hashes of archive members by streaming them directly from archive, without extraction.
+        Tar archive is read only once for all members. Returns dict {member path: hash}.
+        Zip members which can't be read (encrypted or with unsupported compression) are skipped with None hash
+        """
+        member_hashes = dict([(member, None) for member in members])
+        names = dict([(member[len(archive) + len(ARCHIVE_SEPARATOR):], member) for member in members])
+
+        try:
+            if self.throttle:
+                self.throttle.open()
+            if archive.lower().endswith('.zip'):
+                with zipfile.ZipFile(archive) as zip_archive:
+                    for name, member in names.items():
+                        try:
+                            with zip_archive.open(name) as f_file:
+                                blocks = self.read_stream(f_file, block_size=self.block_size, throttle=self.throttle)
+                                member_hashes[member] = self.get_hash_of_blocks(blocks, f_path=member)
+                        except (KeyError, RuntimeError, NotImplementedError, zipfile.BadZipFile) as e:
+                            logger.error(msg='{}: {}'.format(member, e))
+            else:
+                with tarfile.open(archive, mode='r|*') as tar_archive:
+                    for info in tar_archive:
+                        if info.isfile() and info.name in names:
+                            blocks = self.read_stream(tar_archive.extractfile(info), block_size=self.block_size,
+                                                      throttle=self.throttle)
+                            member_hashes[names[info.name]] = self.get_hash_of_blocks(blocks, f_path=names[info.name])
+
+        except (OSError, PermissionError, KeyError, zipfile.BadZipFile, tarfile.TarError) as e:
+            logger.error(msg='{}: {}'.format(archive, e))
+
+        return member_hashes
+
+    def resume(self):
+        """
+        Replay journal and remember already hashed files. Returns number of remembered files
+        """
+        if self.journal:
+            for entry in self.journal.replay():
+                if entry.get('alg') == self.alg and entry.get('digest'):
+                    self.finished[entry['path']] = entry
+
+        return len(self.finished)
+
+    def get_journaled_hash(self, f_path):
+        """
+        Get hash from journal or tree cache if file was not changed since it was hashed.
+        Otherwise calculate hash of file and add it to journal
+        """
+        try:
+            f_stat = self.backend.stat(f_path)
+        except (PermissionError, OSError) as e:
+            logger.error(msg=e)
+            return None
+
+        # Chunks are not journaled, so file should be read again to index them.
+        # File is read again too if digest of some extra algorithm is not journaled
+        entry = self.finished.get(f_path) if not self.chunk_index else None
+        digests = entry.get('digests', {}) if entry else {}
+        if entry and entry['size'] == f_stat.st_size and entry['mtime'] == f_stat.st_mtime_ns and \
+                all([extra_alg in digests for extra_alg in self.extra_algs]):
+            self.stats.add_hashed(entry['size'])
+            if self.extra_algs:
+                self.digests[f_path] = digests
+            return entry['digest']
+
+        f_hash = self.get_hash_of_file(f_path)
+        if f_hash and self.journal:
+            entry = {'path': f_path, 'size': f_stat.st_size, 'mtime': f_stat.st_mtime_ns,
+                     'alg': self.alg, 'digest': f_hash}
+            if f_path in self.digests:
+                entry.update({'digests': self.digests[f_path]})
+            self.journal.add(entry)
+        return f_hash
+
+    @staticmethod
+    def add_hash(hashes, f_hash, f_path, f_digests=None):
+        """
+        Add hash in dict. If it exists - add new path to this hash.
+        Digests of all algorithms are stored by path, if they are calculated
+        """
+        if f_digests:
+            hashes.setdefault(f_hash, {'f_paths': []}).setdefault('f_digests', {})[f_path] = f_digests
+
+        if f_hash in hashes:
+            hashes[f_hash]['f_paths'].append(f_path)
+            paths = set(hashes[f_hash]['f_paths'])  # remove duplicated paths just in case
+            paths = list(paths)
+            paths.sort()
+            hashes[f_hash]['f_paths'] = paths
+        else:
+            hashes.update({f_hash: {'f_paths': [f_path]}})
+
+    def read_small_file(self, f_path):
+        """
+        Read whole content of small file with one read call or request. Returns None if file could not be read
+        or it is not small anymore
+        """
+        try:
+            if self.throttle:
+                self.throttle.open()
+            content = self.backend.read_range(f_path, 0, self.small_file_size + 1)
+
+        except (PermissionError, OSError) as e:
+            logger.error(msg=e)
+            return None
+
+        if len(content) > self.small_file_size:
+            return None
+        if self.throttle:
+            self.throttle.read(len(content))
+        return content
+
+    def get_digests_of_content(self, content):
+        """
+        Get digest of content by main algorithm and dict of digests by all algorithms
+        """
+        hashers = [(alg, hashlib.new(alg)) for alg in [self.alg] + [alg for alg in self.extra_algs if alg != self.alg]]
+        for _, hasher in hashers:
+            hasher.update(content)
+
+        f_digests = dict([(alg, hasher.hexdigest()) for alg, hasher in hashers])
+        return f_digests[self.alg], f_digests if len(f_digests) > 1 else None
+
+    def calculate_hashes_of_small_files(self, hashes, small_files):
+        """
+        Compare small files by their contents in memory, bucket by bucket. Files are read concurrently,
+        digests are calculated only once per group of equal files. Files with unique content are not added
+        to hashes. Files that could not be read as small ones are hashed in usual way.
+        Statistics are counted in calling thread, workers only read files
+        """
+        with ThreadPoolExecutor(max_workers=self.small_file_workers) as executor:
+            for _, f_paths in sorted(small_files.items()):
+                groups = {}
+                for f_path, content in zip(f_paths, executor.map(self.read_small_file, f_paths)):
+                    if content is None:
+                        self.add_hash(hashes=hashes, f_hash=self.get_hash_of_file(f_path), f_path=f_path,
+                                      f_digests=self.digests.pop(f_path, None))
+                    else:
+                        self.stats.add_hashed(len(content))
+                        groups.setdefault(content, []).append(f_path)
+
+                # Group is added at once if there is no such hash yet
+                for content, equal_paths in groups.items():
+                    if len(equal_paths) < 2:
+                        continue
+                    f_hash, f_digests = self.get_digests_of_content(content)
+                    if f_hash not in hashes:
+                        hashes[f_hash] = {'f_paths': sorted(equal_paths)}
+                        if f_digests:
+                            hashes[f_hash]['f_digests'] = dict([(f_path, f_digests) for f_path in equal_paths])
+                        continue
+                    for f_path in equal_paths:
+                        self.add_hash(hashes=hashes, f_hash=f_hash, f_path=f_path, f_digests=f_digests)
+
+    def calculate_hashes(self, equal_files, files=None):
+        """
+        Calculate hashes for all files in list. If sizes of files are known from files dict,
+        small files are compared by content and only their groups of equal files are hashed
+        """
+        hashes = {}
+        archives = {}
+        small_files = {}
+        small_file_size = self.small_file_size if files and not self.chunk_index else 0
+
+        for f_path in equal_files:
+            f_size = files[f_path].get('f_size') if small_file_size and f_path in files else None
+            if f_size is not None and f_size <= small_file_size and ARCHIVE_SEPARATOR not in f_path:
+                small_files.setdefault(f_size, []).append(f_path)
+                continue
+
+            archive_path = Files.split_archive_path(f_path)
+            if archive_path:
+                archives.setdefault(archive_path[0], []).append(f_path)
+                continue
+
+            if self.journal or self.finished:
+                f_hash = self.get_journaled_hash(f_path)
+            else:
+                f_hash = self.get_hash_of_file(f_path)
+            self.add_hash(hashes=hashes, f_hash=f_hash, f_path=f_path, f_digests=self.digests.pop(f_path, None))
+
+        for archive, members in archives.items():
+            for f_path, f_hash in self.get_hashes_of_members(archive, members).items():
+                self.add_hash(hashes=hashes, f_hash=f_hash, f_path=f_path, f_digests=self.digests.pop(f_path, None))
+
+        if small_files:
+            self.calculate_hashes_of_small_files(hashes, small_files)
+
+        if self.journal:
+            self.journal.close()
+        return hashes
+
+
+class Trees:
+    """
+    Finds duplicated directory trees by Merkle digests. Digest of directory is calculated bottom-up
+    from names and digests of its files and subdirectories. Directories without files are not seen
+    """
+
+    def __init__(self, alg=DEFAULT_ALG, cache_file=TREE_CACHE_FILE):
+        self.alg = alg
+        self.cache_file = cache_file
+        self.digests = {}
+        self.sizes = {}
+        self.duplicates = {}
+
+    def get_dir_digests(self, files, hashes, top=None):
+        """
+        Calculate digests and sizes of all directories with found files, given as pairs (path, size).
+        Directory with a file that was not hashed has no digest: such file has no file of equal size,
+        so directory is unique
+        """
+        f_hashes = dict([(f_path, f_hash) for f_hash, h_meta in hashes.items() for f_path in h_meta['f_paths']])
+        top = os.path.normpath(top) if top else None
+        entries = {}
+
+        for f_path, f_size in files:
+            # Archive members are not files of directory tree
+            if ARCHIVE_SEPARATOR in f_path and Files.split_archive_path(f_path):
+                continue
+
+            d_path, name = os.path.split(f_path)
+            entries.setdefault(d_path, []).append(('f', name, f_hashes.get(f_path), f_size or 0))
+
+        # Register parent directories up to the top one. Walk stops at directory registered before
+        for d_path in list(entries):
+            parent = os.path.dirname(d_path)
+            while d_path != top and parent != d_path:
+                registered = parent in entries
+                entries.setdefault(parent, [])
+                if registered:
+                    break
+                d_path, parent = parent, os.path.dirname(parent)
+
+        # Children are always deeper than parents, so digests of subdirectories are ready
+        for d_path in sorted(entries, key=lambda path: path.count(os.sep), reverse=True):
+            lines, d_size = [], 0
+            for kind, name, digest, f_size in entries[d_path]:
+                lines.append(digest and '{}\0{}\0{}'.format(kind, name, digest))
+                d_size += f_size
+
+            self.sizes[d_path] = d_size
+            self.digests[d_path] = self.get_digest(lines)
+            parent, name = os.path.split(d_path)
+            if parent in entries and parent != d_path and d_path != top:
+                entries[parent].append(('d', name, self.digests[d_path], d_size))
+
+        return self.digests
+
+    def get_digest(self, lines):
+        if not all(lines):
+            return None
+
+        hasher = getattr(hashlib, self.alg, hashlib.sha1)()
+        hasher.update('\n'.join(sorted(lines)).encode('utf-8', 'surrogateescape'))
+        return hasher.hexdigest()
+
+    def find_duplicates(self, files, hashes, top=None):
+        """
+        Find groups of directories with equal digests. Group is reported only if some of its directories
+        are outside of already reported trees, so copied subtrees are collapsed to their roots
+        """
+        groups = {}
+        for d_path, digest in self.get_dir_digests(files, hashes, top=top).items():
+            if digest:
+                groups.setdefault(digest, []).append(d_path)
+
+        # Topmost duplicated directory has no duplicated parents, so every group inside it is collapsed
+        groups = dict([(digest, sorted(d_paths)) for digest, d_paths in groups.items() if len(d_paths) > 1])
+        roots = set([d_path for d_paths in groups.values() for d_path in d_paths])
+        for digest, d_paths in sorted(groups.items(), key=lambda item: item[1]):
+            if not all([self.is_inside(os.path.dirname(d_path), roots) for d_path in d_paths]):
+                self.duplicates[digest] = {'f_paths': d_paths, 'f_size': self.sizes[d_paths[0]]}
+
+        return self.duplicates
+
+    @staticmethod
+    def get_root(f_path, roots):
+        """
+        Get directory from roots which is the path itself or contains it. Returns None if there is no such one
+        """
+        while f_path not in roots:
+            parent = os.path.dirname(f_path)
+            if parent == f_path:
+                return None
+            f_path = parent
+        return f_path
+
+    def is_inside(self, f_path, roots):
+        return self.get_root(f_path, roots) is not None
+
+    def collapse(self, duplicates):
+        """
+        Get groups of duplicated files that are not all inside of duplicated trees
+        """
+        roots = set([d_path for d_meta in self.duplicates.values() for d_path in d_meta['f_paths']])
+        return dict([(f_hash, f_meta) for f_hash, f_meta in duplicates.items()
+                     if not all([self.is_inside(f_path, roots) for f_path in f_meta['f_paths']])])
+
+    def load(self, alg=None):
+        """
+        Get files of confirmed duplicated trees from cache in format of journal entries,
+        so they are not read again if they were not changed
+        """
+        if not alg:
+            alg = self.alg
+        if not os.path.isfile(self.cache_file):
+            return {}
+
+        try:
+            with open(self.cache_file, 'r') as cache_file:
+                trees = json.load(cache_file)
+        except (OSError, PermissionError, ValueError) as e:
+            logger.error(msg=e)
+            return {}
+
+        entries = {}
+        for tree in trees.values():
+            if tree.get('alg') == alg:
+                for f_path, (f_size, f_mtime, f_hash) in tree['files'].items():
+                    entries[f_path] = {'path': f_path, 'size': f_size, 'mtime': f_mtime, 'alg': alg, 'digest': f_hash}
+        return entries
+
+    def save(self, hashes, alg=None):
+        """
+        Save files of confirmed duplicated trees with their sizes, modification times and digests
+        """
+        if not alg:
+            alg = self.alg
+        roots = set([d_path for d_meta in self.duplicates.values() for d_path in d_meta['f_paths']])
+        trees = dict([(d_path, {'alg': alg, 'files': {}}) for d_path in roots])
+
+        for f_hash, h_meta in hashes.items():
+            for f_path in h_meta['f_paths']:
+                d_path = self.get_root(f_path, roots)
+                f_stat = Files.get_file_stat(f_path) if d_path and f_hash else None
+                if f_stat:
+                    trees[d_path]['files'][f_path] = [f_stat.st_size, f_stat.st_mtime_ns, f_hash]
+
+        try:
+            with open(self.cache_file, 'w') as cache_file:
+                json.dump(trees, cache_file)
+        except (OSError, PermissionError) as e:
+            logger.error(msg=e)
+
+
+class Estimator:
+    """
+    Estimates size of duplicated files by sampling of size buckets. Buckets are drawn with replacement
+    and probability proportional to their potential waste, so total is estimated by Hansen-Hurwitz estimator
+    """
+
+    def __init__(self, hashes_obj=None, sample_size=ESTIMATE_SAMPLE, z=ESTIMATE_Z, estimates_file=ESTIMATES_FILE,
+                 seed=None):
+        self.hashes_obj = hashes_obj if hashes_obj else Hashes()
+        self.sample_size = sample_size
+        self.z = z
+        self.estimates_file = estimates_file
+        self.random = random.Random(seed)
+
+    @staticmethod
+    def get_buckets(files):
+        """
+        Get dict {size: paths} of files with equal size from pairs (path, size)
+        """
+        buckets = {}
+        for f_path, f_size in files:
+            if f_size is not None:
+                buckets.setdefault(f_size, []).append(f_path)
+
+        return dict([(f_size, sorted(f_paths)) for f_size, f_paths in buckets.items() if len(f_paths) > 1])
+
+    def get_waste(self, f_size, f_paths):
+        """
+        Hash files of bucket and get size of their duplicates
+        """
+        hashes = self.hashes_obj.calculate_hashes(f_paths)
+        return sum([(len(h_meta['f_paths']) - 1) * f_size for f_hash, h_meta in hashes.items() if f_hash])
+
+    def estimate(self, iter_buckets):
+        """
+        Estimate size of duplicated files with confidence interval. Potential waste of bucket is
+        size of all its files except one, it is also the upper bound of estimate.
+        Buckets (size, paths) are read twice from iter_buckets: to weigh them and to get paths of drawn ones,
+        so they are not kept in memory
+        """
+        weights = dict([(f_size, (len(f_paths) - 1) * f_size) for f_size, f_paths in iter_buckets()])
+        max_waste = sum(weights.values())
+        result = {'estimate': 0, 'low': 0, 'high': 0, 'max': max_waste, 'sampled': 0, 'buckets': len(weights)}
+        if not max_waste:
+            return result
+        if not self.sample_size:
+            # Nothing is sampled, so only bounds are known
+            result.update({'high': max_waste})
+            return result
+
+        sizes = [f_size for f_size, weight in weights.items() if weight]
+        sample = self.random.choices(sizes, weights=[weights[f_size] for f_size in sizes], k=self.sample_size)
+
+        # Every drawn bucket is hashed only once
+        drawn = set(sample)
+        wastes = dict([(f_size, self.get_waste(f_size, f_paths)) for f_size, f_paths in iter_buckets()
+                       if f_size in drawn])
+        values = [wastes[f_size] * max_waste / weights[f_size] for f_size in sample]
+        estimate = sum(values) / len(values)
+        variance = sum([(value - estimate) ** 2 for value in values]) / (len(values) * (len(values) - 1)) \
+            if len(values) > 1 else 0
+        margin = self.z * variance ** 0.5
+
+        result.update({'estimate': estimate, 'sampled': len(wastes)})
+        result.update({'low': max(estimate - margin, 0), 'high': min(estimate + margin, max_waste)})
+        return result
+
+    def load(self, top_dir):
+        """
+        Get the last estimate of directory
+        """
+        if not os.path.isfile(self.estimates_file):
+            return None
+
+        try:
+            with open(self.estimates_file, 'r') as estimates_file:
+                return json.load(estimates_file).get(top_dir)
+        except (OSError, PermissionError, ValueError) as e:
+            logger.error(msg=e)
+            return None
+
+    def save(self, top_dir, estimate):
+        estimates = {}
+        if os.path.isfile(self.estimates_file):
+            try:
+                with open(self.estimates_file, 'r') as estimates_file:
+                    estimates = json.load(estimates_file)
+            except (OSError, PermissionError, ValueError) as e:
+                logger.error(msg=e)
+
+        estimates.update({top_dir: estimate})
+        try:
+            with open(self.estimates_file, 'w') as estimates_file:
+                json.dump(estimates, estimates_file)
+        except (OSError, PermissionError) as e:
+            logger.error(msg=e)
+
+
+class BloomFilter:
+    """
+    Bloom filter of bytes keys. Positions of key are derived from one blake2b digest by double hashing.
+    Bits are kept in bytearray or in any buffer, e.g. in memory-mapped file
+    """
+
+    def __init__(self, n_bits, n_hashes, bits=None):
+        self.n_bits = n_bits
+        self.n_hashes = n_hashes
+        self.bits = bits if bits is not None else bytearray((n_bits + 7) // 8)
+
+    @classmethod
+    def create(cls, n_items, fp_rate=FILTER_FP_RATE):
+        """
+        Create filter with optimal number of bits and hashes for number of items and false positive rate
+        """
+        n_items = max(n_items, 1)
+        n_bits = max(int(math.ceil(-n_items * math.log(fp_rate) / math.log(2) ** 2)), 8)
+        n_hashes = max(int(round(n_bits / n_items * math.log(2))), 1)
+        return cls(n_bits, n_hashes)
+
+    def get_positions(self, key):
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self.n_bits for i in range(self.n_hashes)]
+
+    def add(self, key):
+        for position in self.get_positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def check(self, key):
+        """
+        Check if key was probably added. False means it was not added for sure
+        """
+        return all([self.bits[position >> 3] & (1 << (position & 7)) for position in self.get_positions(key)])
+
+
+class DigestFilter:
+    """
+    Bloom filters of digests and sizes of found files, saved to one memory-mappable file.
+    File has header with magic, hashing algorithm, number of files and parameters of filters,
+    then bits of digest filter and bits of size filter
+    """
+
+    MAGIC = b'DUPBLOOM'
+    HEADER = struct.Struct('<8s16sQQQQQ')
+
+    def __init__(self, alg, count, digests, sizes):
+        self.alg = alg
+        self.count = count
+        self.digests = digests
+        self.sizes = sizes
+        self.mapped = None
+
+    @classmethod
+    def build(cls, hashes, sizes, alg, fp_rate=FILTER_FP_RATE):
+        """
+        Build filters from hashes dict and set of sizes of files
+        """
+        f_hashes = [f_hash for f_hash in hashes if f_hash]
+        f_sizes = set(sizes)
+        digest_filter = cls(alg=alg, count=len(f_hashes), digests=BloomFilter.create(len(f_hashes), fp_rate),
+                            sizes=BloomFilter.create(len(f_sizes), fp_rate))
+
+        for f_hash in f_hashes:
+            digest_filter.digests.add(f_hash.encode())
+        for f_size in f_sizes:
+            digest_filter.sizes.add(str(f_size).encode())
+        return digest_filter
+
+    def check_size(self, f_size):
+        return self.sizes.check(str(f_size).encode())
+
+    def check_digest(self, f_hash):
+        return self.digests.check(f_hash.encode())
+
+    def save(self, filename=FILTER_FILE):
+        header = self.HEADER.pack(self.MAGIC, self.alg.encode(), self.count, self.digests.n_bits,
+                                  self.digests.n_hashes, self.sizes.n_bits, self.sizes.n_hashes)
+        try:
+            with open(filename, 'wb') as filter_file:
+                filter_file.write(header)
+                filter_file.write(self.digests.bits)
+                filter_file.write(self.sizes.bits)
+        except (OSError, PermissionError) as e:
+            logger.error(msg=e)
+
+    @classmethod
+    def load(cls, filename=FILTER_FILE):
+        """
+        Map filter file to memory. Bits are read from page cache on demand. Returns None if file is broken
+        """
+        try:
+            with open(filename, 'rb') as filter_file:
+                mapped = mmap.mmap(filter_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, PermissionError, ValueError) as e:
+            logger.error(msg=e)
+            return None
+
+        try:
+            magic, alg, count, digest_bits, digest_hashes, size_bits, size_hashes = cls.HEADER.unpack_from(mapped)
+        except struct.error as e:
+            logger.error(msg='{}: {}'.format(filename, e))
+            mapped.close()
+            return None
+
+        offset = cls.HEADER.size
+        size_offset = offset + (digest_bits + 7) // 8
+        if magic != cls.MAGIC or len(mapped) != size_offset + (size_bits + 7) // 8:
+            logger.error(msg='{}: not a filter file'.format(filename))
+            mapped.close()
+            return None
 
+        bits = memoryview(mapped)
+        digest_filter = cls(alg=alg.rstrip(b'\0').decode(), count=count,
+                            digests=BloomFilter(digest_bits, digest_hashes, bits=bits[offset:size_offset]),
+                            sizes=BloomFilter(size_bits, size_hashes, bits=bits[size_offset:]))
+        digest_filter.mapped = mapped
+        return digest_filter
 
-class Files:
+    def close(self):
+        if self.mapped:
+            self.digests.bits.release()
+            self.sizes.bits.release()
+            self.mapped.close()
+            self.mapped = None
+
+
+class Calibrator:
     """
-    This class works with filesystem
+    Picks the fastest hashing algorithm and read size on this host by micro-benchmark
+    on a sample of real files. Choice is cached per host
     """
 
-    def __init__(self, top_dir=TARGET_DIR, max_files=MAX_FILES):
-        self.top_dir = top_dir
-        self.max_files = max_files
+    def __init__(self, cache_file=CALIBRATION_FILE, algs=None, block_sizes=None, sample_size=CALIBRATION_SAMPLE,
+                 max_bytes=CALIBRATION_BYTES):
+        self.cache_file = cache_file
+        self.algs = algs if algs else CALIBRATION_ALGS
+        self.block_sizes = block_sizes if block_sizes else CALIBRATION_BLOCK_SIZES
+        self.sample_size = sample_size
+        self.max_bytes = max_bytes
+        self.host = socket.gethostname()
 
-    def find(self, top=None, max_files=None):
+    def load(self):
         """
-        Find all files in directory. Limited by max_files
+        Get cached choices for all hosts
         """
-        if not top:
-            top = self.top_dir
-        if not max_files:
-            max_files = self.max_files
+        if not os.path.isfile(self.cache_file):
+            return {}
 
-        files = {}
-        counter = 0
+        try:
+            with open(self.cache_file, 'r') as cache_file:
+                return json.load(cache_file)
+        except (OSError, PermissionError, ValueError) as e:
+            logger.error(msg=e)
+            return {}
 
+    def save(self, choice):
+        choices = self.load()
+        choices.update({self.host: choice})
         try:
-            for result in os.walk(top=top):
-                current_dir, included_dirs, included_files = result
+            with open(self.cache_file, 'w') as cache_file:
+                json.dump(choices, cache_file)
+        except (OSError, PermissionError) as e:
+            logger.error(msg=e)
 
-                # Collect found files to dict and save file size
-                for f in included_files:
-                    f_path = os.path.join(current_dir, f)
+    def read_sample(self, f_paths):
+        """
+        Read beginning of sampled files to memory. Random bytes are used if there are no files to read
+        """
+        data = b''
+        for f_path in f_paths:
+            try:
+                with open(f_path, 'rb') as f_file:
+                    data += f_file.read(self.max_bytes - len(data))
+            except (OSError, PermissionError) as e:
+                logger.error(msg=e)
 
-                    if os.path.isfile(f_path):
-                        files.update({f_path: {"f_size": self.get_file_size(f_path)}})
-                        counter += 1
+            if len(data) >= self.max_bytes:
+                break
 
-                    if counter >= max_files: break
-                if counter >= max_files: break
+        return data if data else os.urandom(self.max_bytes)
 
-        except (OSError, PermissionError) as e:
-            logger.error(msg=e)
+    def benchmark_algs(self, data):
+        """
+        Get the fastest hashing algorithm for data in memory
+        """
+        timing = {}
+        for alg in self.algs:
+            start = time.perf_counter()
+            hashlib.new(alg, data).hexdigest()
+            timing[alg] = time.perf_counter() - start
 
-        return files
+        return min(self.algs, key=lambda alg: timing[alg])
 
-    def find_equal_files(self, files):
+    def benchmark_block_sizes(self, f_paths):
         """
-        Get list of files with equal size
+        Get read size with the best throughput for sampled files. Files are read once before
+        measuring, so every read size works with the same state of cache
         """
-        equal_files = []
-        file_sizes = self.get_files_sizes(files)
+        if not f_paths:
+            return BLOCK_SIZE
+
+        self.read_sample(f_paths)
+        timing = {}
+        for block_size in self.block_sizes:
+            start = time.perf_counter()
+            for f_path in f_paths:
+                try:
+                    with open(f_path, 'rb') as f_file:
+                        for _ in Hashes.read_stream(f_file, block_size):
+                            pass
+                except (OSError, PermissionError) as e:
+                    logger.error(msg=e)
+            timing[block_size] = time.perf_counter() - start
+
+        return min(self.block_sizes, key=lambda block_size: timing[block_size])
+
+    def calibrate(self, f_paths):
+        """
+        Get cached choice for this host or benchmark sample of files.
+        Choice is cached only if it was measured on real files.
+        Returns dict with hashing algorithm and block size
+        """
+        choice = self.load().get(self.host)
+        if choice:
+            return choice
 
-        for f_path, f_meta in files.items():
-            if f_meta and f_meta.get('f_size') and file_sizes.count(f_meta['f_size']) > 1:
-                equal_files.append(f_path)
+        f_paths = list(f_paths)
+        sample = random.sample(f_paths, min(self.sample_size, len(f_paths)))
+        choice = {'alg': self.benchmark_algs(self.read_sample(sample)),
+                  'block_size': self.benchmark_block_sizes(sample)}
+        logger.info(msg='Calibrated on {} files: {}'.format(len(sample), choice))
 
-        equal_files.sort()
-        return equal_files
+        if sample:
+            self.save(choice)
+        return choice
+
+
+class Deduplicator:
+    """
+    Class replaces duplicated files with reflinks or hardlinks to the first file in group.
+    Every replacement is written to journal, so interrupted or finished run could be rolled back
+    """
+
+    def __init__(self, mode=DEDUPE_MODE, journal=None, workers=PROCESSES, batch_size=DEDUPE_BATCH):
+        self.mode = mode
+        self.journal = journal if journal else Journal(filename=DEDUPE_JOURNAL_FILE)
+        # Every step of replacement should be on disk before the next one
+        self.journal.batch_size = 1
+        self.workers = workers
+        self.batch_size = batch_size
 
     @staticmethod
-    def get_file_size(f_path):
+    def compare_files(f_path, other_path, block_size=BLOCK_SIZE):
+        """
+        Compare content of two files chunk by chunk
+        """
         try:
-            return os.path.getsize(f_path)
-        except OSError as e:
+            with open(f_path, 'rb') as f_file, open(other_path, 'rb') as other_file:
+                while True:
+                    buf = f_file.read(block_size)
+                    if buf != other_file.read(block_size):
+                        return False
+                    if not buf:
+                        return True
+
+        except (PermissionError, OSError) as e:
             logger.error(msg=e)
-            return 0
+            return False
 
     @staticmethod
-    def get_files_sizes(files):
+    def reflink(src, dst):
         """
-        Get list with sizes of all checked files
+        Create copy-on-write clone of src. Raises OSError if filesystem does not support it
         """
-        file_sizes = []
-        for f_meta in files.values():
-            if f_meta and f_meta.get("f_size"):
-                file_sizes.append(int(f_meta["f_size"]))
+        if not fcntl:
+            raise OSError('Reflinks are not supported on this platform')
 
-        file_sizes.sort()
-        return file_sizes
+        with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        shutil.copystat(src, dst)
 
-    @staticmethod
-    def write_dict_to_file(results, filename):
+    def link(self, src, dst):
         """
-        Write dictionary with results to output file
+        Create reflink or hardlink from src to dst. Returns type of created link
         """
-        try:
-            with open(filename, 'a+') as results_file:
-                json.dump(results, results_file)
-                results_file.write("\n")
+        if self.mode in ('auto', 'reflink'):
+            try:
+                self.reflink(src, dst)
+                return 'reflink'
+
+            except OSError as e:
+                if os.path.isfile(dst):
+                    os.remove(dst)
+                if self.mode == 'reflink':
+                    raise
+                logger.debug(msg='Reflink is not created, use hardlink: {}'.format(e))
+
+        os.link(src, dst)
+        return 'hardlink'
+
+    def replace_file(self, src, dst):
+        """
+        Replace dst with link to src after final comparison of both files.
+        Original file is kept as backup until link is in place. Returns type of created link or None
+        """
+        if os.path.islink(src) or os.path.islink(dst) or os.path.samefile(src, dst):
+            return None
 
-        except (OSError, PermissionError) as e:
-            logger.info(msg=e)
+        if not self.compare_files(src, dst):
+            logger.warning(msg='Files are not equal, skip: {} {}'.format(src, dst))
+            return None
 
+        tmp, backup = dst + '.dedupe_tmp', dst + '.dedupe_backup'
+        self.journal.add({'action': 'begin', 'src': src, 'dst': dst, 'tmp': tmp, 'backup': backup})
+        link_type = self.link(src, tmp)
+        os.link(dst, backup)
+        os.replace(tmp, dst)
+        self.journal.add({'action': 'done', 'dst': dst, 'link': link_type})
+        os.remove(backup)
+        return link_type
 
-class Hashes:
-    """
-    Class calculates hashes for files and for stores them
-    """
+    def deduplicate_group(self, f_paths):
+        """
+        Replace all files in group except the first one. Returns number of replaced files and reclaimed bytes
+        """
+        replaced, reclaimed = 0, 0
 
-    def __init__(self, alg=DEFAULT_ALG):
-        self.alg = alg
+        # Archive members can't be replaced with links
+        f_paths = [f_path for f_path in f_paths if not Files.split_archive_path(f_path)]
+        if not f_paths:
+            return replaced, reclaimed
+        src = f_paths[0]
 
-    def get_hash_of_file(self, f_path, alg=None):
+        for dst in f_paths[1:]:
+            try:
+                f_size = os.path.getsize(dst)
+                if self.replace_file(src, dst):
+                    replaced += 1
+                    reclaimed += f_size
+
+            except (PermissionError, OSError) as e:
+                logger.error(msg=e)
+
+        return replaced, reclaimed
+
+    def deduplicate(self, duplicates):
         """
-        Open file, calculate hash of file and return it if it exists
+        Replace duplicated files group by group. Groups are processed in parallel batches.
+        Empty files are not replaced: nothing is reclaimed, and unrelated lock or marker files would be linked
         """
-        if not alg:
-            alg = self.alg
-        hasher = getattr(hashlib, alg, hashlib.sha1)()
+        replaced, reclaimed = 0, 0
+        groups = [f_meta['f_paths'] for f_meta in duplicates.values() if f_meta.get('f_size') != 0]
 
-        try:
-            with open(f_path, 'rb') as f_file:
-                for buf in f_file:
-                    hasher.update(buf)
-            return hasher.hexdigest()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for start in range(0, len(groups), self.batch_size):
+                for group_replaced, group_reclaimed in executor.map(self.deduplicate_group,
+                                                                    groups[start:start + self.batch_size]):
+                    replaced += group_replaced
+                    reclaimed += group_reclaimed
 
-        except (PermissionError, OSError) as e:
+        self.journal.close()
+        return replaced, reclaimed
+
+    def rollback(self):
+        """
+        Roll back replacements from journal. Unfinished replacements are restored from backups,
+        finished hardlinks are replaced with independent copies. Returns number of restored files.
+        Journal is removed only if all files were restored, otherwise it keeps entries of failed ones to retry
+        """
+        restored = 0
+        failed = set()
+        entries = self.journal.replay()
+        finished = dict([(entry['dst'], entry) for entry in entries if entry['action'] == 'done'])
+
+        for entry in reversed([entry for entry in entries if entry['action'] == 'begin']):
+            dst, tmp, backup = entry['dst'], entry['tmp'], entry['backup']
+
+            try:
+                if dst not in finished and os.path.isfile(backup):
+                    os.replace(backup, dst)
+                    restored += 1
+
+                elif dst in finished and finished[dst]['link'] == 'hardlink':
+                    shutil.copy2(dst, tmp)
+                    os.replace(tmp, dst)
+                    restored += 1
+
+                for f_path in (tmp, backup):
+                    if os.path.isfile(f_path):
+                        os.remove(f_path)
+
+            except (PermissionError, OSError) as e:
+                logger.error(msg=e)
+                failed.add(dst)
+
+        self.journal.close()
+        if failed:
+            self.rewrite_journal([entry for entry in entries if entry['dst'] in failed])
+        elif os.path.isfile(self.journal.filename):
+            os.remove(self.journal.filename)
+        return restored
+
+    def rewrite_journal(self, entries):
+        """
+        Replace journal with given entries. New journal is written next to old one and then renamed,
+        so entries are not lost if writing fails
+        """
+        tmp_journal = Journal(filename=self.journal.filename + '.tmp', batch_size=len(entries))
+        for entry in entries:
+            tmp_journal.add(entry)
+        tmp_journal.close()
+
+        try:
+            os.replace(tmp_journal.filename, self.journal.filename)
+        except (OSError, PermissionError) as e:
             logger.error(msg=e)
-            return None
+        logger.warning(msg='Rollback failed for {} files, journal is kept: {}'.format(
+            len(set([entry['dst'] for entry in entries])), self.journal.filename))
 
-    @staticmethod
-    def add_hash(hashes, f_hash, f_path):
+
+class DuplicatesIndex:
+    """
+    In-memory index of files by size, hash and path. Kept warm by daemon to answer lookup requests
+    """
+
+    def __init__(self, hashes_obj=None):
+        self.hashes_obj = hashes_obj if hashes_obj else Hashes()
+        self.sizes = {}
+        self.digests = {}
+        self.paths = {}
+        self.lock = threading.Lock()
+
+    def build(self, files):
         """
-        Add hash in dict. If it exists - add new path to this hash
+        Calculate hashes of all found files from pairs (path, size) and add them to index
         """
-        if f_hash in hashes:
-            hashes[f_hash]['f_paths'].append(f_path)
-            paths = set(hashes[f_hash]['f_paths'])  # remove duplicated paths just in case
-            paths = list(paths)
-            paths.sort()
-            hashes[f_hash]['f_paths'] = paths
+        for f_path, f_size in files:
+            try:
+                self.add(f_path, f_size=f_size)
+            except OSError as e:
+                logger.error(msg=e)
+        return len(self.paths)
+
+    def add(self, f_path, f_size=None):
+        """
+        Add new file to index or update changed one. Raise OSError if file can't be read
+        """
+        archive_path = Files.split_archive_path(f_path)
+        if archive_path:
+            f_hash = self.hashes_obj.get_hashes_of_members(archive_path[0], [f_path])[f_path]
         else:
-            hashes.update({f_hash: {'f_paths': [f_path]}})
+            if f_size is None:
+                f_size = self.hashes_obj.backend.stat(f_path).st_size
+            f_hash = self.hashes_obj.get_hash_of_file(f_path)
+
+        if f_hash is None:
+            raise OSError(errno.EIO, 'Can\'t read file', f_path)
+
+        f_meta = {'f_size': f_size, 'f_hash': f_hash}
+        with self.lock:
+            self._remove(f_path)
+            self.paths[f_path] = f_meta
+            self.sizes.setdefault(f_size, set()).add(f_path)
+            if f_hash:
+                self.digests.setdefault(f_hash, set()).add(f_path)
+
+        return f_meta
+
+    def remove(self, f_path):
+        with self.lock:
+            return self._remove(f_path)
+
+    def _remove(self, f_path):
+        f_meta = self.paths.pop(f_path, None)
+        if not f_meta:
+            return False
+
+        for index, key in ((self.sizes, f_meta['f_size']), (self.digests, f_meta['f_hash'])):
+            if key in index:
+                index[key].discard(f_path)
+                if not index[key]:
+                    index.pop(key)
+        return True
+
+    def lookup_size(self, f_size):
+        with self.lock:
+            return sorted(self.sizes.get(f_size, []))
+
+    def lookup_digest(self, f_hash):
+        with self.lock:
+            return sorted(self.digests.get(f_hash, []))
+
+    def lookup_path(self, f_path):
+        with self.lock:
+            return self.paths.get(f_path)
+
+    def handle_request(self, request):
+        """
+        Handle one request {"op": ..., args}. Returns response {"ok": bool, "result" or "error": ...}
+        """
+        try:
+            op = request['op']
+            if op == 'size':
+                result = self.lookup_size(int(request['size']))
+            elif op == 'digest':
+                result = self.lookup_digest(request['digest'])
+            elif op == 'path':
+                result = self.lookup_path(request['path'])
+            elif op == 'add':
+                result = self.add(request['path'])
+            elif op == 'remove':
+                result = self.remove(request['path'])
+            elif op == 'stats':
+                result = {'files': len(self.paths), 'sizes': len(self.sizes), 'digests': len(self.digests)}
+            else:
+                return {'ok': False, 'error': 'Unknown operation: {}'.format(op)}
+
+        except (KeyError, TypeError, ValueError) as e:
+            return {'ok': False, 'error': 'Bad request: {}'.format(e)}
+        except OSError as e:
+            return {'ok': False, 'error': str(e)}
 
-    def calculate_hashes(self, equal_files):
+        return {'ok': True, 'result': result}
+
+
+class IndexRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Read json requests line by line from client and write json responses
+    """
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = self.server.index.handle_request(json.loads(line))
+            except ValueError as e:
+                response = {'ok': False, 'error': 'Bad request: {}'.format(e)}
+            self.wfile.write((json.dumps(response) + '\n').encode())
+
+
+class IndexDaemon:
+    """
+    Serves duplicates index over local Unix socket
+    """
+
+    def __init__(self, index, socket_path=SOCKET_FILE):
+        self.index = index
+        self.socket_path = socket_path
+        self.server = None
+
+    def start(self):
         """
-        Calculate hashes for all files in list
+        Bind socket. Stale socket file from previous run is removed, any other file is left untouched
         """
-        hashes = {}
+        try:
+            if stat.S_ISSOCK(os.stat(self.socket_path).st_mode):
+                os.remove(self.socket_path)
+        except FileNotFoundError:
+            pass
 
-        for f_path in equal_files:
-            f_hash = self.get_hash_of_file(f_path)
-            self.add_hash(hashes=hashes, f_hash=f_hash, f_path=f_path)
+        self.server = socketserver.ThreadingUnixStreamServer(self.socket_path, IndexRequestHandler)
+        self.server.daemon_threads = True
+        self.server.index = self.index
 
-        return hashes
+    def serve_forever(self):
+        if not self.server:
+            self.start()
+        self.server.serve_forever()
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+def query_index(request, socket_path=SOCKET_FILE):
+    """
+    Send one request to index daemon and return its response
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall((json.dumps(request) + '\n').encode())
+        with client.makefile('r') as response_file:
+            return json.loads(response_file.readline())
 
 
 class Duplicates:
@@ -209,8 +2323,20 @@ class Duplicates:
         self.duplicates = {}
         self.results = OrderedDict()
 
-        # Init time measuring dict
+        # Set up report of duplicates: top N groups and paged output
+        self.top = self.args.top if self.args else None
+        self.pager = self.args.pager if self.args else False
+        self.top_duplicates = []
+
+        # Set up finding of duplicated directory trees
+        trees = self.args.trees if self.args else False
+        tree_cache = self.args.tree_cache if self.args else TREE_CACHE_FILE
+        self.trees_obj = Trees(cache_file=tree_cache) if trees else None
+        self.duplicate_trees = {}
+
+        # Init time measuring dict and statistics shared by all stages
         self.timing = {}
+        self.stats = Statistics()
 
         # Set up unit of measuring
         self.unit = self.args.unit if self.args else SIZE_UNIT
@@ -219,13 +2345,118 @@ class Duplicates:
         # Create and init Files object
         top_dir = self.args.path if self.args else TARGET_DIR
         max_files = self.args.max if self.args else MAX_FILES
+        archives = self.args.archives if self.args else False
+        max_memory = self.args.max_memory if self.args else MAX_MEMORY
+        scratch_dir = self.args.scratch_dir if self.args else None
+        columnar = self.args.columnar if self.args else False
+        one_filesystem = self.args.one_filesystem if self.args else False
+        exclude_fstypes = self.args.exclude_fstype if self.args else None
+        follow_links = self.args.follow_links if self.args else False
+        walkers = self.args.walkers if self.args else WALKERS
+        self.backend = self.get_backend(top_dir)
+        if columnar and not numpy:
+            logger.warning(msg='NumPy is not installed, columnar index uses pure Python grouping')
         self.top_dir = top_dir
-        self.files_obj = Files(top_dir=top_dir, max_files=max_files)
-
-        # Create and init Hashes object
-        alg = self.args.alg if self.args else DEFAULT_ALG
+        self.files_obj = Files(top_dir=top_dir, max_files=max_files, stats=self.stats, archives=archives,
+                               max_memory=max_memory, scratch_dir=scratch_dir, columnar=columnar,
+                               one_filesystem=one_filesystem, exclude_fstypes=exclude_fstypes,
+                               follow_links=follow_links, walkers=walkers, backend=self.backend)
+
+        # Create and init Hashes object. Files are grouped by digest of the first algorithm
+        algs = self.args.alg if self.args else [DEFAULT_ALG]
+        alg = algs[0]
+        extra_algs = [extra_alg for extra_alg in OrderedDict.fromkeys(algs[1:]) if extra_alg not in (alg, 'auto')]
+        block_size = self.args.block_size if self.args else BLOCK_SIZE
         self.alg = alg
-        self.hashes_obj = Hashes(alg=alg)
+        self.extra_algs = extra_algs
+        self.block_size = block_size
+        self.calibrator = Calibrator()
+        self.resume = self.args.resume if self.args else False
+        journal_file = self.args.journal if self.args else None
+        if self.resume and not journal_file:
+            journal_file = JOURNAL_FILE
+        journal = Journal(filename=journal_file) if journal_file else None
+        chunks = self.args.chunks if self.args else False
+        self.chunk_index = ChunkIndex() if chunks else None
+        cache_polite = self.args.cache_polite if self.args else False
+        readahead = self.args.readahead * 1024 if self.args else READAHEAD
+        small_file_size = self.args.small_file_size if self.args else SMALL_FILE_SIZE
+        small_file_workers = self.args.small_file_workers if self.args else SMALL_FILE_WORKERS
+        self.throttle = self.get_throttle()
+        self.hashes_obj = Hashes(alg=DEFAULT_ALG if alg == 'auto' else alg, journal=journal, stats=self.stats,
+                                 chunk_index=self.chunk_index, cache_polite=cache_polite, readahead=readahead,
+                                 block_size=BLOCK_SIZE if block_size == 'auto' else block_size, throttle=self.throttle,
+                                 extra_algs=extra_algs, small_file_size=small_file_size,
+                                 small_file_workers=small_file_workers, backend=self.backend)
+
+        # Create and init Estimator object. Estimates are compared with results of the next full run
+        self.estimate_mode = self.args.estimate if self.args else False
+        sample_size = self.args.sample if self.args else ESTIMATE_SAMPLE
+        estimates_file = self.args.estimates_file if self.args else ESTIMATES_FILE
+        self.estimator = Estimator(hashes_obj=self.hashes_obj, sample_size=sample_size, estimates_file=estimates_file)
+        self.estimate = {}
+
+        # Set up export of digest filter and check of found files with filter from another host
+        self.export_filter = self.args.export_filter if self.args else None
+        self.check_filter = self.args.check_filter if self.args else None
+        self.fp_rate = self.args.fp_rate if self.args else FILTER_FP_RATE
+        self.filter_matches = {}
+        self.filter_matches_size = 0
+
+        # Create and init Deduplicator object
+        dedupe_journal = self.args.dedupe_journal if self.args else DEDUPE_JOURNAL_FILE
+        self.dedupe_mode = self.args.dedupe if self.args else None
+        self.dedupe_obj = Deduplicator(mode=self.dedupe_mode or DEDUPE_MODE, journal=Journal(filename=dedupe_journal))
+
+    def get_backend(self, top_dir):
+        """
+        Create storage backend. Object store stand-in uses target directory as its bucket
+        """
+        backend = self.args.backend if self.args else BACKEND
+        page_size = self.args.page_size if self.args else PAGE_SIZE
+        if backend == 'object-store':
+            latency = self.args.backend_latency / 1000 if self.args else BACKEND_LATENCY
+            range_size = self.args.range_size * 1024 if self.args else RANGE_SIZE
+            return ObjectStoreBackend(root=top_dir, latency=latency, page_size=page_size, range_size=range_size)
+        return LocalBackend(page_size=page_size)
+
+    def get_throttle(self):
+        """
+        Create Throttle object if rates are limited or could be limited at runtime by control file.
+        SIGUSR1 makes throttle re-read control file immediately
+        """
+        read_rate = self.args.max_read_rate * 1024 ** 2 if self.args else MAX_READ_RATE
+        open_rate = self.args.max_open_rate if self.args else MAX_OPEN_RATE
+        control_file = self.args.throttle_control if self.args else None
+        if not read_rate and not open_rate and not control_file:
+            return None
+
+        throttle = Throttle(read_rate=read_rate, open_rate=open_rate, control_file=control_file)
+        if control_file and hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, throttle.handle_signal)
+        return throttle
+
+    def iter_files(self):
+        """
+        Get pairs (path, size) of all found files from files dict, from sorted runs in external-memory mode
+        or from columnar index
+        """
+        if self.files:
+            for f_path, f_meta in self.files.items():
+                yield f_path, f_meta.get('f_size') if f_meta else None
+        elif self.files_obj.sorter:
+            for f_size, f_path in self.files_obj.sorter.merge():
+                yield f_path, f_size
+        elif self.files_obj.columns:
+            yield from zip(self.files_obj.columns.paths, self.files_obj.columns.sizes)
+
+    def iter_buckets(self):
+        """
+        Get pairs (size, paths) of files with equal size. Sorter gives them bucket by bucket
+        """
+        if not self.files and self.files_obj.sorter:
+            return self.files_obj.sorter.find_equal_sizes()
+        return iter(self.estimator.get_buckets(self.iter_files()).items())
 
     def convert_bytes_to(self, n_bytes, degree=None):
         """
@@ -264,6 +2495,18 @@ class Duplicates:
         if not files:
             files = self.files
 
+        if not files and self.files_obj.columns:
+            logger.info(msg='Start checking found files for equal size in columnar index')
+            self.equal_files = self.files_obj.columns.find_candidates()
+            logger.info(msg='Complete checking found files')
+            return self.equal_files.copy()
+
+        # Buckets of equal files are merged from sorted runs lazily, while they are hashed
+        if not files and self.files_obj.sorter:
+            logger.info(msg='Merge sorted runs of found files by size')
+            self.equal_files = self.files_obj.iter_equal_files()
+            return self.equal_files
+
         logger.info(msg='Start checking found files for equal size')
         equal_files = self.files_obj.find_equal_files(files=files)
         logger.info(msg='Complete checking found files')
@@ -279,14 +2522,48 @@ class Duplicates:
         """
         logger.info(msg='Start calculating hashes')
 
-        if not equal_files:
+        # Partially equal files could have any size, so all found files are candidates for chunk index
+        if not equal_files and self.chunk_index:
+            equal_files = sorted([f_path for f_path, _ in self.iter_files()])
+        elif not equal_files:
             equal_files = self.equal_files
 
-        hashes = self.hashes_obj.calculate_hashes(equal_files=equal_files)
+        # Equal files from sorter are read only once, so calibration samples the first buckets, like estimate does
+        if isinstance(equal_files, list):
+            self.calibrate(equal_files)
+        else:
+            self.calibrate([f_paths[0] for _, f_paths in itertools.islice(self.iter_buckets(), CALIBRATION_SAMPLE)])
+
+        if self.resume:
+            resumed = self.hashes_obj.resume()
+            logger.info(msg='Resume hashing. Files in journal: {}'.format(resumed))
+
+        # Files of duplicated trees confirmed by previous run are not read again
+        if self.trees_obj:
+            cached = self.trees_obj.load(alg=self.alg)
+            self.hashes_obj.finished.update(cached)
+            logger.info(msg='Files in tree cache: {}'.format(len(cached)))
+
+        hashes = self.hashes_obj.calculate_hashes(equal_files=equal_files, files=self.files)
         logger.info(msg='Complete calculating hashes')
         self.hashes = deepcopy(hashes)
         return hashes
 
+    def calibrate(self, f_paths):
+        """
+        Choose hashing algorithm and block size with Calibrator object, if they are set to auto
+        """
+        if self.alg != 'auto' and self.block_size != 'auto':
+            return
+
+        choice = self.calibrator.calibrate(f_paths)
+        if self.alg == 'auto':
+            self.alg = self.hashes_obj.alg = choice['alg']
+            self.extra_algs = self.hashes_obj.extra_algs = [alg for alg in self.extra_algs if alg != self.alg]
+        if self.block_size == 'auto':
+            self.block_size = self.hashes_obj.block_size = choice['block_size']
+        logger.info(msg='Use algorithm {} and block size {}'.format(self.alg, self.block_size))
+
     @measure_execution(section='Finding time')
     def find_duplicates(self, hashes=None):
         """
@@ -298,24 +2575,202 @@ class Duplicates:
         if not hashes:
             hashes = self.hashes
         duplicates = {}
+        top_heap = []
 
         for f_hash, paths in hashes.items():
 
-            if len(paths['f_paths'][1:]):
+            # Files that could not be read have no hash
+            if f_hash and len(paths['f_paths'][1:]):
                 f_size = self.get_file_size(paths['f_paths'])
                 duplicates.update({f_hash: {'f_paths': paths['f_paths'], 'f_size': f_size}})
+                if paths.get('f_digests'):
+                    duplicates[f_hash].update({'f_digests': paths['f_digests']})
+                self.stats.add_duplicates(f_size=f_size, n_paths=len(paths['f_paths']))
+
+                # Keep only top groups with the biggest size of duplicated files
+                if self.top:
+                    self.push_to_top(top_heap, f_hash, (len(paths['f_paths']) - 1) * f_size)
 
         logger.info(msg='Complete finding equal files')
         self.duplicates = deepcopy(duplicates)
+        self.top_duplicates = [f_hash for _, f_hash in sorted(top_heap, reverse=True)]
         return duplicates
 
+    @measure_execution(section='Trees time')
+    def find_duplicate_trees(self, files=None, hashes=None):
+        """
+        Find duplicated directory trees by Merkle digests using Trees object and save them to tree cache.
+        Keep passing vars and returning result for unit tests
+        """
+        logger.info(msg='Start finding equal directory trees')
+
+        if not files:
+            files = self.iter_files()
+        if not hashes:
+            hashes = self.hashes
+
+        self.trees_obj.alg = self.alg
+        duplicate_trees = self.trees_obj.find_duplicates(files=files, hashes=hashes, top=self.top_dir)
+        self.trees_obj.save(hashes=hashes)
+
+        logger.info(msg='Complete finding equal directory trees')
+        self.duplicate_trees = deepcopy(duplicate_trees)
+        return duplicate_trees
+
+    def push_to_top(self, top_heap, f_hash, duplicated_size, top=None):
+        """
+        Push group to bounded min-heap. The smallest group is dropped when heap is full
+        """
+        if not top:
+            top = self.top
+
+        if len(top_heap) < top:
+            heapq.heappush(top_heap, (duplicated_size, f_hash))
+        elif (duplicated_size, f_hash) > top_heap[0]:
+            heapq.heapreplace(top_heap, (duplicated_size, f_hash))
+
+    @measure_execution(section='Estimation time')
+    def estimate_duplicates(self, iter_buckets=None):
+        """
+        Estimate size of duplicated files by hashing of sampled size buckets using Estimator object and save estimate.
+        Keep passing var and returning result for unit tests
+        """
+        if not iter_buckets:
+            iter_buckets = self.iter_buckets
+
+        logger.info(msg='Start estimating size of duplicated files')
+        self.calibrate([f_paths[0] for _, f_paths in itertools.islice(iter_buckets(), CALIBRATION_SAMPLE)])
+        estimate = self.estimator.estimate(iter_buckets)
+        self.estimator.save(self.top_dir, estimate)
+        logger.info(msg='Complete estimating. Sampled buckets: {}'.format(estimate['sampled']))
+
+        self.estimate = deepcopy(estimate)
+        return estimate
+
+    @measure_execution(section='Export time')
+    def export_digest_filter(self, files=None, filter_file=None):
+        """
+        Hash all found files and export Bloom filters of their digests and sizes.
+        Files are pairs (path, size), all found files by default.
+        Keep passing vars and returning result for unit tests
+        """
+        if not files:
+            files = self.iter_files()
+        if not filter_file:
+            filter_file = self.export_filter if self.export_filter else FILTER_FILE
+
+        logger.info(msg='Start exporting filter of all found files')
+        f_paths, f_sizes = [], set()
+        for f_path, f_size in files:
+            f_paths.append(f_path)
+            if f_size is not None:
+                f_sizes.add(f_size)
+        f_paths.sort()
+
+        self.calibrate(f_paths)
+        self.hashes = self.hashes_obj.calculate_hashes(equal_files=f_paths)
+        digest_filter = DigestFilter.build(hashes=self.hashes, sizes=f_sizes, alg=self.alg, fp_rate=self.fp_rate)
+        digest_filter.save(filename=filter_file)
+        logger.info(msg='Complete exporting filter: {}'.format(filter_file))
+        return digest_filter
+
+    @measure_execution(section='Check time')
+    def check_with_filter(self, files=None, filter_file=None):
+        """
+        Find files that probably exist on another host using its exported filter. Only files with probably
+        present size are hashed, and with algorithm of filter. Matches should be compared exactly later.
+        Files are pairs (path, size), all found files by default.
+        Keep passing vars and returning result for unit tests
+        """
+        if not files:
+            files = self.iter_files()
+        if not filter_file:
+            filter_file = self.check_filter if self.check_filter else FILTER_FILE
+
+        logger.info(msg='Start checking found files with filter: {}'.format(filter_file))
+        digest_filter = DigestFilter.load(filename=filter_file)
+        if not digest_filter:
+            return {}
+
+        self.alg = self.hashes_obj.alg = digest_filter.alg
+        candidates = dict([(f_path, f_size) for f_path, f_size in files
+                           if f_size is not None and digest_filter.check_size(f_size)])
+        self.hashes = self.hashes_obj.calculate_hashes(equal_files=sorted(candidates))
+
+        matches = {}
+        for f_hash, h_meta in self.hashes.items():
+            if f_hash and digest_filter.check_digest(f_hash):
+                matches.update(dict([(f_path, f_hash) for f_path in h_meta['f_paths']]))
+        digest_filter.close()
+
+        logger.info(msg='Complete checking with filter. Probable matches: {}'.format(len(matches)))
+        self.filter_matches = deepcopy(matches)
+        self.filter_matches_size = sum([candidates[f_path] for f_path in matches])
+        return matches
+
+    @measure_execution(section='Dedupe time')
+    def dedupe_duplicates(self, duplicates=None):
+        """
+        Replace duplicated files with links using Deduplicator object.
+        Keep passing var and returning result for unit tests
+        """
+        if not duplicates:
+            duplicates = self.duplicates
+
+        logger.info(msg='Start replacing duplicated files with links')
+        replaced, reclaimed = self.dedupe_obj.deduplicate(duplicates=duplicates)
+        logger.info(msg='Complete replacing duplicated files. Replaced files: {}'.format(replaced))
+
+        self.stats.replaced_count += replaced
+        self.stats.reclaimed_size += reclaimed
+        return replaced, reclaimed
+
+    def rollback_dedupe(self):
+        """
+        Roll back replacements of duplicated files from dedupe journal
+        """
+        logger.info(msg='Start rollback of replaced files')
+        restored = self.dedupe_obj.rollback()
+        logger.info(msg='Complete rollback. Restored files: {}'.format(restored))
+        return restored
+
+    def serve_index(self, socket_path=None, files=None):
+        """
+        Build index of found files and serve lookup requests over Unix socket until interrupted.
+        Files are pairs (path, size), all found files by default
+        """
+        if not socket_path:
+            socket_path = self.args.daemon if self.args else SOCKET_FILE
+        if not files:
+            files = list(self.iter_files())
+
+        logger.info(msg='Start building index')
+        self.calibrate([f_path for f_path, _ in files])
+        index = DuplicatesIndex(hashes_obj=self.hashes_obj)
+        indexed = index.build(files)
+        self.files_obj.close()
+        logger.info(msg='Complete building index. Files in index: {}'.format(indexed))
+
+        daemon = IndexDaemon(index=index, socket_path=socket_path)
+        daemon.start()
+        logger.info(msg='Serve index on socket: {}'.format(socket_path))
+
+        # Stop daemon in the same way on Ctrl+C and on kill
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            daemon.serve_forever()
+        except KeyboardInterrupt:
+            logger.info(msg='Stop serving index')
+        finally:
+            daemon.shutdown()
+
     def get_file_size(self, f_paths):
         """
         Try to get file size files dict or directly from OS. Because all files in list have equal size,
         it's normal to get any of them.
         """
         for f_path in f_paths:
-            if f_path in self.files.keys() and self.files[f_path]['f_size']:
+            if f_path in self.files.keys() and self.files[f_path]['f_size'] is not None:
                 return self.files[f_path]['f_size']
 
         for f_path in f_paths:
@@ -375,20 +2830,107 @@ class Duplicates:
 
     def calculate_results(self):
         """
-        Aggregate results of check in dict
+        Aggregate results of check in dict. All sizes are taken from statistics collected by stages
         """
         logger.debug(msg='Calculating results')
         self.results.update({"Target directory": self.top_dir})
-        self.results.update({"Files found": self.files.__len__()})
-        self.results.update({"Scanned files size": "{} {}".format(self.get_scanned_size(), self.unit)})
+        self.results.update({"Files found": self.stats.files_count})
+        self.results.update({"Scanned files size": "{} {}".format(
+            self.convert_bytes_to(self.stats.scanned_size), self.unit)})
+        self.results.update({"Size histogram": self.stats.get_histogram()})
         self.results.update({"Scanning time": "{} sec".format(self.timing.get('Scanning time', 0))})
         self.results.update({"Checking time": "{} sec".format(self.timing.get('Checking time', 0))})
-        self.results.update({"Files hashed": self.hashes.__len__()})
-        self.results.update({"Hashed files size": "{} {}".format(self.get_hashed_size(), self.unit)})
+        self.results.update({"Files hashed": self.stats.hashed_count})
+        self.results.update({"Hashed files size": "{} {}".format(
+            self.convert_bytes_to(self.stats.hashed_size), self.unit)})
         self.results.update({"Hashing time": "{} sec".format(self.timing.get('Hashing time', 0))})
         self.results.update({"Duplicates found": self.duplicates.__len__()})
-        self.results.update({"Duplicates size": "{} {}".format(self.get_duplicates_size(), self.unit)})
+        self.results.update({"Duplicates size": "{} {}".format(
+            self.convert_bytes_to(self.stats.duplicates_size), self.unit)})
         self.results.update({"Finding time": "{} sec".format(self.timing.get('Finding time', 0))})
+        self.compare_with_estimate()
+        if self.trees_obj:
+            trees_size = sum([(len(d_meta['f_paths']) - 1) * d_meta['f_size']
+                              for d_meta in self.duplicate_trees.values()])
+            self.results.update({"Duplicate trees found": self.duplicate_trees.__len__()})
+            self.results.update({"Duplicate trees size": "{} {}".format(self.convert_bytes_to(trees_size), self.unit)})
+            self.results.update({"Trees time": "{} sec".format(self.timing.get('Trees time', 0))})
+        if self.chunk_index:
+            self.results.update({"Chunks indexed": self.chunk_index.chunks.__len__()})
+            self.results.update({"Shared chunks size": "{} {}".format(
+                self.convert_bytes_to(self.chunk_index.get_shared_size()), self.unit)})
+        if 'Dedupe time' in self.timing:
+            self.results.update({"Files replaced": self.stats.replaced_count})
+            self.results.update({"Reclaimed size": "{} {}".format(
+                self.convert_bytes_to(self.stats.reclaimed_size), self.unit)})
+            self.results.update({"Dedupe time": "{} sec".format(self.timing['Dedupe time'])})
+        if self.backend.paged:
+            self.results.update({"Backend requests": dict(self.backend.requests)})
+        self.results.update({"Total time": "{} sec".format(round(sum(self.timing.values()), 2))})
+        self.results.update({"Algorithm": ', '.join([self.alg] + self.extra_algs)})
+
+    def compare_with_estimate(self):
+        """
+        Add the last estimate of target directory to results, to check how close it was to found size of duplicates
+        """
+        estimate = self.estimator.load(self.top_dir)
+        if not estimate:
+            return
+
+        duplicates_size = self.stats.duplicates_size
+        self.results.update({"Estimated duplicates size": "{} {}".format(
+            self.convert_bytes_to(estimate['estimate']), self.unit)})
+        if duplicates_size:
+            self.results.update({"Estimate error": "{} %".format(
+                round((estimate['estimate'] - duplicates_size) * 100 / duplicates_size, 2))})
+        self.results.update({"Estimate in confidence interval": estimate['low'] <= duplicates_size <= estimate['high']})
+
+    def calculate_estimate_results(self):
+        """
+        Aggregate results of estimate in dict
+        """
+        logger.debug(msg='Calculating results of estimate')
+        self.results.update({"Target directory": self.top_dir})
+        self.results.update({"Files found": self.stats.files_count})
+        self.results.update({"Scanned files size": "{} {}".format(
+            self.convert_bytes_to(self.stats.scanned_size), self.unit)})
+        self.results.update({"Size histogram": self.stats.get_histogram()})
+        self.results.update({"Scanning time": "{} sec".format(self.timing.get('Scanning time', 0))})
+        self.results.update({"Size buckets": self.estimate['buckets']})
+        self.results.update({"Sampled buckets": self.estimate['sampled']})
+        self.results.update({"Files hashed": self.stats.hashed_count})
+        self.results.update({"Estimated duplicates size": "{} {}".format(
+            self.convert_bytes_to(self.estimate['estimate']), self.unit)})
+        self.results.update({"Confidence interval": "{} - {} {}".format(
+            self.convert_bytes_to(self.estimate['low']), self.convert_bytes_to(self.estimate['high']), self.unit)})
+        self.results.update({"Max duplicates size": "{} {}".format(
+            self.convert_bytes_to(self.estimate['max']), self.unit)})
+        self.results.update({"Estimation time": "{} sec".format(self.timing.get('Estimation time', 0))})
+        self.results.update({"Total time": "{} sec".format(round(sum(self.timing.values()), 2))})
+        self.results.update({"Algorithm": self.alg})
+
+    def calculate_filter_results(self):
+        """
+        Aggregate results of export or check of digest filter in dict
+        """
+        logger.debug(msg='Calculating results of filter')
+        self.results.update({"Target directory": self.top_dir})
+        self.results.update({"Files found": self.stats.files_count})
+        self.results.update({"Scanned files size": "{} {}".format(
+            self.convert_bytes_to(self.stats.scanned_size), self.unit)})
+        self.results.update({"Scanning time": "{} sec".format(self.timing.get('Scanning time', 0))})
+        self.results.update({"Files hashed": self.stats.hashed_count})
+        self.results.update({"Hashed files size": "{} {}".format(
+            self.convert_bytes_to(self.stats.hashed_size), self.unit)})
+        if self.export_filter:
+            self.results.update({"Filter file": self.export_filter})
+            self.results.update({"Export time": "{} sec".format(self.timing.get('Export time', 0))})
+        else:
+            self.results.update({"Filter file": self.check_filter})
+            self.results.update({"Probable matches": self.filter_matches.__len__()})
+            self.results.update({"Probable matches size": "{} {}".format(
+                self.convert_bytes_to(self.filter_matches_size), self.unit)})
+            self.results.update({"Check time": "{} sec".format(self.timing.get('Check time', 0))})
         self.results.update({"Total time": "{} sec".format(round(sum(self.timing.values()), 2))})
         self.results.update({"Algorithm": self.alg})
 
@@ -398,29 +2940,74 @@ class Duplicates:
             print("{}: {}".format(key, value))
             logger.debug(msg="{}: {}".format(key, value))
 
-    def show_duplicates_in_console(self):
-        logger.info(msg='Show duplicates in console')
-        for _, f_meta in self.duplicates.items():
-            print('=' * 100)
-            print('\n'.join([f_path for f_path in f_meta['f_paths']]))
+    def format_duplicates(self, duplicates, kind='File'):
+        """
+        Format groups of duplicated files or directories to one block of text
+        """
+        lines = []
+        for f_meta in duplicates:
+            lines.append('=' * 100)
+
+            # Digests of all algorithms are shown after path
+            f_digests = f_meta.get('f_digests', {})
+            for f_path in f_meta['f_paths']:
+                digests = ['{}:{}'.format(alg, digest) for alg, digest in f_digests.get(f_path, {}).items()]
+                lines.append(' '.join([f_path] + digests))
 
             f_size = f_meta['f_size']
             f_size = round(f_size / (1024 ** self.degree), 2)
             duplicated_size = (len(f_meta['f_paths']) - 1) * f_size
             duplicated_size = round(duplicated_size, 2)
-            total_str = 'File size: {0} {2}. Total size of duplicated files: {1} {2}'
-            total_str = total_str.format(f_size, duplicated_size, self.unit)
+            total_str = '{3} size: {0} {2}. Total size of duplicated files: {1} {2}'
+            lines.append(total_str.format(f_size, duplicated_size, self.unit, kind))
+
+        lines.append('=' * 100)
+        return '\n'.join(lines)
+
+    def show_text(self, text):
+        """
+        Write text to console as one buffered block or show it page by page
+        """
+        text += '\n'
+        if self.pager:
+            pydoc.pager(text)
+        else:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+
+    def show_duplicates_in_console(self):
+        logger.info(msg='Show duplicates in console')
+        duplicates = self.duplicates
+        text = ''
 
-            print(total_str)
-            logger.debug(msg=total_str)
-        print('=' * 100)
+        # Files of duplicated trees are shown only as their trees
+        if self.trees_obj:
+            duplicates = self.trees_obj.collapse(duplicates)
+            text = self.format_duplicates(self.duplicate_trees.values(), kind='Directory') + '\n'
+
+        if self.top:
+            duplicates = [duplicates[f_hash] for f_hash in self.top_duplicates if f_hash in duplicates]
+        else:
+            duplicates = duplicates.values()
+        self.show_text(text + self.format_duplicates(duplicates))
+
+    def show_shared_chunks_in_console(self, max_pairs=CHUNK_PAIRS_SHOWN):
+        logger.info(msg='Show files with shared chunks in console')
+        lines = []
+        for (f_path, other_path), shared_size in self.chunk_index.get_shared_pairs()[:max_pairs]:
+            lines.extend(['=' * 100, f_path, other_path])
+            lines.append('Shared chunks size: {} {}'.format(self.convert_bytes_to(shared_size), self.unit))
+        lines.append('=' * 100)
+        self.show_text('\n'.join(lines))
 
     def show_results(self):
         """
         Show results in console if flags allow that
         """
-        if self.args and not self.args.quiet and self.args.verbose:
+        if self.args and not self.args.quiet and (self.args.verbose or self.top):
             self.show_duplicates_in_console()
+            if self.chunk_index:
+                self.show_shared_chunks_in_console()
 
         elif not self.args and not QUIET and VERBOSE:
             self.show_duplicates_in_console()
@@ -454,10 +3041,49 @@ if __name__ == '__main__':
     else:
         duplicates_obj = Duplicates()
 
+    if duplicates_obj.args and duplicates_obj.args.rollback:
+        duplicates_obj.rollback_dedupe()
+        sys.exit(0)
+
+    if duplicates_obj.args and duplicates_obj.args.daemon:
+        duplicates_obj.find_all_files()
+        duplicates_obj.serve_index()
+        sys.exit(0)
+
+    if duplicates_obj.export_filter or duplicates_obj.check_filter:
+        duplicates_obj.find_all_files()
+        if duplicates_obj.export_filter:
+            duplicates_obj.export_digest_filter()
+        else:
+            duplicates_obj.check_with_filter()
+        duplicates_obj.files_obj.close()
+        duplicates_obj.calculate_filter_results()
+        if duplicates_obj.args and duplicates_obj.args.verbose and not duplicates_obj.args.quiet:
+            duplicates_obj.show_text('\n'.join(sorted(duplicates_obj.filter_matches)))
+        if not duplicates_obj.args or not duplicates_obj.args.quiet:
+            duplicates_obj.show_results_in_console()
+        duplicates_obj.write_results()
+        sys.exit(0)
+
+    if duplicates_obj.estimate_mode:
+        duplicates_obj.find_all_files()
+        duplicates_obj.estimate_duplicates()
+        duplicates_obj.files_obj.close()
+        duplicates_obj.calculate_estimate_results()
+        if not duplicates_obj.args or not duplicates_obj.args.quiet:
+            duplicates_obj.show_results_in_console()
+        duplicates_obj.write_results()
+        sys.exit(0)
+
     duplicates_obj.find_all_files()
     duplicates_obj.check_all_files()
     duplicates_obj.get_files_hashes()
     duplicates_obj.find_duplicates()
+    if duplicates_obj.trees_obj:
+        duplicates_obj.find_duplicate_trees()
+    duplicates_obj.files_obj.close()
+    if duplicates_obj.dedupe_mode:
+        duplicates_obj.dedupe_duplicates()
     duplicates_obj.calculate_results()
     duplicates_obj.show_results()
     duplicates_obj.write_results()
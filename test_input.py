@@ -3,6 +3,15 @@ import os
 
 TEST_DIR = r'test_dir'
 TEST_FILE = r'test.bin'
+TEST_JOURNAL = r'test_journal.txt'
+TEST_ARCHIVES = [r'test.zip', r'test.tar', r'test.tar.gz']
+TEST_SOCKET = r'test.sock'
+TEST_CALIBRATION = r'test_calibration.json'
+TEST_MOUNTS = r'test_mounts.txt'
+TEST_TREE_CACHE = r'test_tree_cache.json'
+TEST_THROTTLE = r'test_throttle.json'
+TEST_ESTIMATES = r'test_estimates.json'
+TEST_FILTER = r'test_filter.bloom'
 
 
 # test description, input dict, expected result
@@ -11,6 +20,7 @@ EQUALITY_CHECK = [
     ('Test dict with not equal files', {'test_path_0': {'f_size': 123}, 'test_path_1': {'f_size': 321}}, []),
     ('Test dict with empty file size', {'test_path_0': {'f_size': 123}, 'test_path_1': {'f_size': None}}, []),
     ('Test dict with empty meta dict', {'test_path_0': {'f_size': 123}, 'test_path_1': {}}, []),
+    ('Test dict with empty files', {'test_path_0': {'f_size': 0}, 'test_path_1': {'f_size': 0}}, True),
     ('Test empty dict', {}, [])
 ]
 
@@ -27,6 +37,7 @@ DUPLICATES_CHECK = [
     ('Test dict with hash that has multiple files',
      {'hash0': {'f_paths': ['path0', 'path1']}, 'hash1': {'f_paths': ['path2']}},
      {'hash0': {'f_paths': ['path0', 'path1'], 'f_size': 0}}),
+    ('Test dict with files that could not be hashed', {None: {'f_paths': ['path0', 'path1']}}, {}),
     ('Test dict with unique hashes and files',
      {'hash0': {'f_paths': ['path0']}, 'hash1': {'f_paths': ['path1']}}, {}),
     ('Test empty dict', {}, {}),
@@ -111,3 +122,108 @@ INTEGRATION_DUPLICATES_CHECK = [
     ('Test dict with diff files by size', {'dir0': {'file0.txt': 1000, 'file1.txt': 10000, 'file2.txt': 100000}}, {}),
     ('Test dict with equal files by size', {'dir0': {'file0.txt': 1000, 'file1.txt': 1000, 'file2.txt': 1000}}, 3)
 ]
+
+# test description, journal entries, batch size, expected number of entries in journal file before flush
+JOURNAL_CHECK = [
+    ('Test batch is not full', [{'path': 'path0'}, {'path': 'path1'}], 3, 0),
+    ('Test batch is full', [{'path': 'path0'}, {'path': 'path1'}, {'path': 'path2'}], 3, 3),
+    ('Test one entry per batch', [{'path': 'path0'}, {'path': 'path1'}], 1, 2)
+]
+
+# test description, file size, expected size class
+SIZE_CLASS_CHECK = [
+    ('Test empty file', 0, '0 B'),
+    ('Test file less than kilobyte', 1023, '< 1 KB'),
+    ('Test file equal to kilobyte', 1024, '< 1 MB'),
+    ('Test file less than terabyte', 1024 ** 4 - 1, '< 1 TB'),
+    ('Test file bigger than terabyte', 1024 ** 4 * 5, '>= 1 TB')
+]
+
+# test description, input dict, memory limit in MB, expected groups of equal files
+SORTER_CHECK = [
+    ('Test records in memory', {'path0': 100, 'path1': 200, 'path2': 100}, 1, [(100, ['path0', 'path2'])]),
+    ('Test every record spilled to disk', {'path0': 100, 'path1': 200, 'path2': 100, 'path3': 200, 'path4': 300},
+     0.0001, [(100, ['path0', 'path2']), (200, ['path1', 'path3'])]),
+    ('Test empty files', {'path0': 0, 'path1': 0}, 0.0001, [(0, ['path0', 'path1'])]),
+    ('Test no records', {}, 1, [])
+]
+
+# test description, list of (offset, data) written to sparse file, file size
+SPARSE_CHECK = [
+    ('Test file with holes only', [], 3 * 65536 + 100),
+    ('Test file with data between holes', [(70000, b'data'), (200000, b'more data')], 300000),
+    ('Test file with data at the end', [(65536 * 2 - 2, b'data')], 65536 * 2 + 2),
+    ('Test empty file', [], 0)
+]
+
+# test description, list of (file path, file size, (device, inode)), expected candidates for hashing
+COLUMNAR_CHECK = [
+    ('Test files with equal size', [('path0', 100, (1, 1)), ('path1', 100, (1, 2)), ('path2', 200, (1, 3))],
+     ['path0', 'path1']),
+    ('Test hardlinks are collapsed', [('path0', 100, (1, 1)), ('path1', 100, (1, 1)), ('path2', 100, (1, 2))],
+     ['path0', 'path2']),
+    ('Test only hardlinks of one file', [('path0', 100, (1, 1)), ('path1', 100, (1, 1))], []),
+    ('Test same inode on different devices', [('path0', 100, (1, 1)), ('path1', 100, (2, 1))], ['path0', 'path1']),
+    ('Test archive members without inode', [('path0', 100, None), ('path1', 100, None)], ['path0', 'path1']),
+    ('Test empty index', [], [])
+]
+
+# test description, duplicates dict, top N, expected hashes of top groups
+TOP_CHECK = [
+    ('Test top group by size of duplicated files',
+     {'hash0': {'f_paths': ['path0', 'path1'], 'f_size': 100}, 'hash1': {'f_paths': ['path2', 'path3'], 'f_size': 300},
+      'hash2': {'f_paths': ['path4', 'path5', 'path6'], 'f_size': 200}}, 1, ['hash2']),
+    ('Test top groups are sorted',
+     {'hash0': {'f_paths': ['path0', 'path1'], 'f_size': 100}, 'hash1': {'f_paths': ['path2', 'path3'], 'f_size': 300},
+      'hash2': {'f_paths': ['path4', 'path5', 'path6'], 'f_size': 200}}, 2, ['hash2', 'hash1']),
+    ('Test top is bigger than number of groups',
+     {'hash0': {'f_paths': ['path0', 'path1'], 'f_size': 100}}, 5, ['hash0']),
+]
+
+# test description, content of mounts file, expected dict {mount point: filesystem type}
+MOUNTS_CHECK = [
+    ('Test usual mounts', 'proc /proc proc rw 0 0\n/dev/sda1 / ext4 rw 0 0\n', {'/proc': 'proc', '/': 'ext4'}),
+    ('Test mount point with space', 'server:/share /mnt/my\\040share nfs rw 0 0\n', {'/mnt/my share': 'nfs'}),
+    ('Test broken line', 'broken\n', {})
+]
+
+# test description, input dict with file structure
+WALK_CHECK = [
+    ('Test nested directories', {'dir0': {'file0.txt': 10, 'file1.txt': 20}, os.path.join('dir0', 'dir1'): {'file2.txt': 30},
+                                 os.path.join('dir0', 'dir1', 'dir2'): {'file3.txt': 40}, 'dir3': {'file4.txt': 50}}),
+    ('Test empty directories', {'dir0': {}, 'dir1': {}, os.path.join('dir1', 'dir2'): {}})
+]
+
+# test description, dict {file path: size}, hashes dict, expected groups of duplicated trees, expected collapsed hashes
+TREES_CHECK = [
+    ('Test copied tree with subtree',
+     {os.path.join('top', 'A', 'x'): 10, os.path.join('top', 'A', 'sub', 'y'): 20, os.path.join('top', 'B', 'x'): 10,
+      os.path.join('top', 'B', 'sub', 'y'): 20, os.path.join('top', 'C', 'y'): 20},
+     {'hash0': {'f_paths': [os.path.join('top', 'A', 'x'), os.path.join('top', 'B', 'x')]},
+      'hash1': {'f_paths': [os.path.join('top', 'A', 'sub', 'y'), os.path.join('top', 'B', 'sub', 'y'),
+                            os.path.join('top', 'C', 'y')]}},
+     [[os.path.join('top', 'A'), os.path.join('top', 'B')],
+      [os.path.join('top', 'A', 'sub'), os.path.join('top', 'B', 'sub'), os.path.join('top', 'C')]], []),
+    ('Test copied subtree',
+     {os.path.join('top', 'A', 'x'): 10, os.path.join('top', 'A', 'sub', 'y'): 20, os.path.join('top', 'B', 'w'): 10,
+      os.path.join('top', 'B', 'sub', 'y'): 20},
+     {'hash0': {'f_paths': [os.path.join('top', 'A', 'x'), os.path.join('top', 'B', 'w')]},
+      'hash1': {'f_paths': [os.path.join('top', 'A', 'sub', 'y'), os.path.join('top', 'B', 'sub', 'y')]}},
+     [[os.path.join('top', 'A', 'sub'), os.path.join('top', 'B', 'sub')]], ['hash0']),
+    ('Test trees with different names of files',
+     {os.path.join('top', 'A', 'x'): 10, os.path.join('top', 'B', 'w'): 10},
+     {'hash0': {'f_paths': [os.path.join('top', 'A', 'x'), os.path.join('top', 'B', 'w')]}},
+     [], ['hash0']),
+    ('Test tree with file that was not hashed',
+     {os.path.join('top', 'A', 'x'): 10, os.path.join('top', 'A', 'u'): 30, os.path.join('top', 'B', 'x'): 10},
+     {'hash0': {'f_paths': [os.path.join('top', 'A', 'x'), os.path.join('top', 'B', 'x')]}},
+     [], ['hash0'])
+]
+
+# test description, dict {size: number of files in bucket}, dict {size: size of duplicates in bucket}, expected size
+ESTIMATE_CHECK = [
+    ('Test all files are duplicated', {100: 2, 200: 3, 300: 4}, {100: 100, 200: 400, 300: 900}, 1400),
+    ('Test no duplicated files', {100: 2, 200: 3, 300: 4}, {100: 0, 200: 0, 300: 0}, 0),
+    ('Test part of files are duplicated', {100: 2, 200: 3, 300: 4, 400: 2}, {100: 100, 200: 0, 300: 300, 400: 0}, 400),
+    ('Test empty files', {0: 5}, {0: 0}, 0)
+]
@@ -59,6 +59,37 @@ class IntegrationFiles(Integration):
                 self.assertEqual(equal_files, expected)
 
 
+class IntegrationExternalFiles(Integration):
+    """
+    Check intercommunication of methods from Files class in external-memory mode
+    """
+
+    def setUp(self):
+        self.files_instance = duplicates.Files(max_memory=0.0001)
+
+    def test_files_class(self):
+        """
+        Method 'find' should pass all files to sorter.
+        Then method 'iter_equal_files' should find equal by size files in sorted runs.
+        """
+
+        for desc, input_dict, expected in INTEGRATION_FILES_CHECK:
+            with self.subTest(msg=desc):
+
+                # Create file structure in current directory for test find method
+                old_dir, test_dir = self.create_file_structure(input_dict=input_dict)
+
+                # Check created directory with files
+                files = self.files_instance.find(top=test_dir)
+                equal_files = list(self.files_instance.iter_equal_files())
+                self.files_instance.close()
+
+                # Clean up
+                self.delete_file_structure(old_dir, test_dir)
+                self.assertEqual(files, {})
+                self.assertEqual(equal_files, expected)
+
+
 class IntegrationHashes(Integration):
     """
     Check intercommunication of methods from Hashes class and methods from Files class
@@ -1,11 +1,29 @@
+import io
 import os
+import json
+import random
+import hashlib
+import tarfile
+import zipfile
+import signal
+import threading
 import unittest
+import unittest.mock
 import duplicates
 import file_handler
 
 
 from test_input import TEST_DIR
 from test_input import TEST_FILE
+from test_input import TEST_JOURNAL
+from test_input import TEST_ARCHIVES
+from test_input import TEST_SOCKET
+from test_input import TEST_CALIBRATION
+from test_input import TEST_MOUNTS
+from test_input import TEST_TREE_CACHE
+from test_input import TEST_THROTTLE
+from test_input import TEST_ESTIMATES
+from test_input import TEST_FILTER
 from test_input import EQUALITY_CHECK
 from test_input import SIZE_CHECK
 from test_input import DUPLICATES_CHECK
@@ -15,6 +33,16 @@ from test_input import HASHING_CHECK
 from test_input import SCAN_SIZE_CHECK
 from test_input import HASH_SIZE_CHECK
 from test_input import DUPLICATES_SIZE_CHECK
+from test_input import JOURNAL_CHECK
+from test_input import SIZE_CLASS_CHECK
+from test_input import SORTER_CHECK
+from test_input import SPARSE_CHECK
+from test_input import COLUMNAR_CHECK
+from test_input import TOP_CHECK
+from test_input import MOUNTS_CHECK
+from test_input import WALK_CHECK
+from test_input import TREES_CHECK
+from test_input import ESTIMATE_CHECK
 
 
 class Unit(unittest.TestCase):
@@ -37,6 +65,115 @@ class Unit(unittest.TestCase):
         os.chdir(old_dir)
         file_handler.delete_dir_recursively(test_dir)
 
+    @staticmethod
+    def create_archives(files):
+        # Create zip and tar archives with the same files
+        for archive in TEST_ARCHIVES:
+            if archive.endswith('.zip'):
+                with zipfile.ZipFile(archive, 'w') as zip_archive:
+                    for filename in files:
+                        zip_archive.write(filename)
+            else:
+                with tarfile.open(archive, 'w:gz' if archive.endswith('.gz') else 'w') as tar_archive:
+                    for filename in files:
+                        tar_archive.add(filename)
+
+
+class UnitStatistics(Unit):
+
+    def setUp(self):
+        self.stats_instance = duplicates.Statistics()
+
+    def test_get_size_class(self):
+        """
+        Check get_size_class method of Statistics class. It returns name of size class for file size.
+        """
+        for desc, f_size, expected in SIZE_CLASS_CHECK:
+            with self.subTest(msg=desc):
+                self.assertEqual(self.stats_instance.get_size_class(f_size), expected)
+
+    def test_add(self):
+        """
+        Check add methods of Statistics class. They accumulate counters and histogram of scanned files.
+        """
+        for f_size in (0, 100, 200, 2048):
+            self.stats_instance.add_scanned(f_size)
+        self.stats_instance.add_hashed(100)
+        self.stats_instance.add_duplicates(f_size=100, n_paths=3)
+
+        self.assertEqual(self.stats_instance.files_count, 4)
+        self.assertEqual(self.stats_instance.scanned_size, 2348)
+        self.assertEqual(self.stats_instance.hashed_size, 100)
+        self.assertEqual(self.stats_instance.duplicates_size, 200)
+        self.assertEqual(self.stats_instance.get_histogram(), {'0 B': 1, '< 1 KB': 2, '< 1 MB': 1})
+
+
+class UnitSizeSorter(Unit):
+
+    def test_find_equal_sizes(self):
+        """
+        Check find_equal_sizes method of SizeSorter class. Records over memory limit are spilled to run files,
+        then runs are merged to groups of files with equal size.
+        """
+        for desc, input_dict, max_memory, expected in SORTER_CHECK:
+            with self.subTest(msg=desc):
+                sorter = duplicates.SizeSorter(max_memory=max_memory)
+                for f_path, f_size in input_dict.items():
+                    sorter.add(f_path, f_size)
+                runs = sorter.runs.copy()
+
+                result = list(sorter.find_equal_sizes())
+                sorter.close()
+                self.assertEqual(result, expected)
+                self.assertFalse(any([os.path.isfile(run) for run in runs]))
+
+    def test_multi_pass_merge(self):
+        """
+        Check that runs over fan-in limit are merged in several passes with the same result
+        """
+        for desc, input_dict, max_memory, expected in SORTER_CHECK:
+            with self.subTest(msg=desc):
+                sorter = duplicates.SizeSorter(max_memory=max_memory, fan_in=2)
+                for f_path, f_size in input_dict.items():
+                    sorter.add(f_path, f_size)
+                runs = sorter.runs.copy()
+
+                result = list(sorter.find_equal_sizes())
+                merged_runs = sorter.runs.copy()
+                sorter.close()
+                self.assertEqual(result, expected)
+                self.assertLessEqual(len(merged_runs), 2)
+                self.assertFalse(any([os.path.isfile(run) for run in runs + merged_runs]))
+
+
+class UnitColumnarIndex(Unit):
+
+    def create_index(self, records):
+        columns = duplicates.ColumnarIndex()
+        for f_path, f_size, f_id in records:
+            columns.add(f_path, f_size, f_id=f_id)
+        return columns
+
+    def test_find_candidates_python(self):
+        """
+        Check find_candidates_python method of ColumnarIndex class. It finds files with equal size
+        and collapses hardlinks without NumPy.
+        """
+        for desc, records, expected in COLUMNAR_CHECK:
+            with self.subTest(msg=desc):
+                columns = self.create_index(records)
+                result = sorted([columns.paths[index] for index in columns.find_candidates_python()])
+                self.assertEqual(result, expected)
+
+    @unittest.skipUnless(duplicates.numpy, 'NumPy is not installed')
+    def test_find_candidates_numpy(self):
+        """
+        Check find_candidates method of ColumnarIndex class with NumPy.
+        """
+        for desc, records, expected in COLUMNAR_CHECK:
+            with self.subTest(msg=desc):
+                self.assertEqual(self.create_index(records).find_candidates(), expected)
+
 
 class UnitFiles(Unit):
 
@@ -57,6 +194,129 @@ class UnitFiles(Unit):
                 results = [True if isinstance(size, int) else False for size in result]
                 self.assertTrue(all(results))
 
+    def test_find_stats(self):
+        """
+        Check that find method of Files class collects statistics of scanned files.
+        """
+        _, input_dict, expected = FIND_CHECK[0]
+        old_dir, test_dir = self.create_file_structure(input_dict=input_dict)
+        self.files_instance.find(top=test_dir)
+        self.delete_file_structure(old_dir, test_dir)
+
+        self.assertEqual(self.files_instance.stats.files_count, len(expected))
+        self.assertEqual(self.files_instance.stats.scanned_size, sum([f['f_size'] for f in expected.values()]))
+
+    def test_find_follow_links(self):
+        """
+        Check find method of Files class with symlinked directories. Every directory is walked only once,
+        symlink loops do not break walking.
+        """
+        input_dict = {'dir0': {'file0.txt': 1000}}
+        old_dir, test_dir = self.create_file_structure(input_dict=input_dict)
+        os.symlink(test_dir, os.path.join(test_dir, 'dir0', 'loop'))
+        os.symlink(os.path.join(test_dir, 'dir0'), os.path.join(test_dir, 'link0'))
+
+        with self.subTest(msg='Test symlinks are not followed'):
+            result = self.files_instance.find(top=test_dir)
+            self.assertEqual(list(result), [os.path.join(test_dir, 'dir0', 'file0.txt')])
+
+        with self.subTest(msg='Test symlinks are followed once'):
+            files_instance = duplicates.Files(follow_links=True)
+            result = files_instance.find(top=test_dir)
+            self.assertEqual(len(result), 1)
+
+        self.delete_file_structure(old_dir, test_dir)
+
+    def test_find_one_filesystem(self):
+        """
+        Check find method of Files class in one-filesystem mode. Directories on other devices are not walked.
+        """
+        input_dict = {'dir0': {'file0.txt': 1000}, 'dir1': {'file1.txt': 1000}}
+        old_dir, test_dir = self.create_file_structure(input_dict=input_dict)
+        other_dir = os.path.join(test_dir, 'dir1')
+        get_file_stat = duplicates.Files.get_file_stat
+
+        def get_other_device_stat(f_path):
+            # Pretend that dir1 is a mount point of other filesystem
+            f_stat = get_file_stat(f_path)
+            if f_path == other_dir:
+                return os.stat_result((f_stat.st_mode, f_stat.st_ino, f_stat.st_dev + 1) + tuple(f_stat)[3:])
+            return f_stat
+
+        files_instance = duplicates.Files(one_filesystem=True)
+        with unittest.mock.patch.object(files_instance, 'get_file_stat', side_effect=get_other_device_stat):
+            result = files_instance.find(top=test_dir)
+        self.delete_file_structure(old_dir, test_dir)
+
+        self.assertEqual(list(result), [os.path.join(test_dir, 'dir0', 'file0.txt')])
+
+    def test_walk_concurrently(self):
+        """
+        Check walk_concurrently method of Files class. It walks directories in the same order as os.walk
+        and keeps max_files semantics of find method.
+        """
+        files_instance = duplicates.Files(walkers=4, walk_queue=2)
+
+        for desc, input_dict in WALK_CHECK:
+            with self.subTest(msg=desc):
+                old_dir, test_dir = self.create_file_structure(input_dict=input_dict)
+                result = list(files_instance.walk_concurrently(test_dir))
+                expected = list(os.walk(test_dir))
+
+                max_files = 3
+                result_files = files_instance.find(top=test_dir, max_files=max_files)
+                expected_files = self.files_instance.find(top=test_dir, max_files=max_files)
+
+                self.delete_file_structure(old_dir, test_dir)
+                self.assertEqual(result, expected)
+                self.assertEqual(list(result_files), list(expected_files))
+
+    def test_get_mounts(self):
+        """
+        Check get_mounts method of Files class. It parses mount points and filesystem types.
+        """
+        for desc, content, expected in MOUNTS_CHECK:
+            with self.subTest(msg=desc):
+                with open(TEST_MOUNTS, 'w') as mounts_file:
+                    mounts_file.write(content)
+                result = self.files_instance.get_mounts(mounts_file=TEST_MOUNTS)
+                file_handler.delete_file(TEST_MOUNTS)
+                self.assertEqual(result, expected)
+
+    def test_get_archive_members(self):
+        """
+        Check get_archive_members method of Files class. It lists files in zip and tar archives with their sizes.
+        Member path could be split back to archive and member name.
+        """
+        files = file_handler.create_files(filename=TEST_FILE, n=1, n_bytes=1000)
+        files += file_handler.create_files(filename=TEST_FILE.replace('.', '_big.'), n=1, n_bytes=2000)
+        self.create_archives(files)
+
+        for archive in TEST_ARCHIVES:
+            with self.subTest(msg='Test archive {}'.format(archive)):
+                members = self.files_instance.get_archive_members(archive)
+                exp_members = [(archive + duplicates.ARCHIVE_SEPARATOR + f, os.path.getsize(f)) for f in files]
+                self.assertEqual(members, exp_members)
+                self.assertEqual(self.files_instance.split_archive_path(members[0][0]), (archive, files[0]))
+
+        file_handler.delete_list_of_files(files + TEST_ARCHIVES)
+        self.assertIsNone(self.files_instance.split_archive_path(exp_members[0][0]))
+
+    def test_find_archive_members_max_files(self):
+        """
+        Check that find method of Files class counts archive members in max_files
+        """
+        old_dir, test_dir = self.create_file_structure(input_dict={})
+        files = file_handler.create_files(filename=TEST_FILE, n=2, n_bytes=1000)
+        with zipfile.ZipFile(TEST_ARCHIVES[0], 'w') as zip_archive:
+            for filename in files:
+                zip_archive.write(filename)
+        file_handler.delete_list_of_files(files)
+
+        result = duplicates.Files(archives=True).find(top=test_dir, max_files=2)
+        self.delete_file_structure(old_dir, test_dir)
+        self.assertEqual(len(result), 2)
+
     def test_find_equal_files(self):
         """
         Check find_equal_files method of Files class. This method checks dict with files {file path: {file size, etc}}
@@ -114,6 +374,204 @@ class UnitHashes(Unit):
         result = self.hashes_instance.get_hash_of_file(f_path=filename)
         self.assertFalse(result, msg='Hash should be None')
 
+    def test_extra_algs(self):
+        """
+        Check calculate_hashes method in Hashes class with extra algorithms. Files are grouped by the first digest,
+        digests of all algorithms are stored for every file and journaled
+        """
+        files = [TEST_FILE]
+        with open(TEST_FILE, 'wb') as f_file:
+            f_file.write(os.urandom(10000))
+        with open(TEST_FILE, 'rb') as f_file:
+            content = f_file.read()
+
+        hashes_instance = duplicates.Hashes(alg='md5', extra_algs=['sha256'], journal=duplicates.Journal(TEST_JOURNAL))
+        result = hashes_instance.calculate_hashes(files)
+        resumed_instance = duplicates.Hashes(alg='md5', extra_algs=['sha256'], journal=duplicates.Journal(TEST_JOURNAL))
+        resumed_instance.resume()
+        with unittest.mock.patch.object(resumed_instance, 'get_hash_of_file') as get_hash_of_file:
+            resumed = resumed_instance.calculate_hashes(files)
+        file_handler.delete_list_of_files(files + [TEST_JOURNAL])
+
+        digests = {'md5': hashlib.md5(content).hexdigest(), 'sha256': hashlib.sha256(content).hexdigest()}
+        self.assertEqual(result, {digests['md5']: {'f_paths': files, 'f_digests': {TEST_FILE: digests}}})
+        self.assertEqual(resumed, result)
+        get_hash_of_file.assert_not_called()
+
+    def test_small_files(self):
+        """
+        Check calculate_hashes method in Hashes class with small files. They are compared by content
+        without reading them block by block and only groups of equal files are hashed
+        """
+        contents = [b'content0', b'content0', b'content1', b'content1', b'content1', b'content2', b'']
+        files, f_contents = {}, {}
+        for i, content in enumerate(contents):
+            f_path = 'small_file_{}.bin'.format(i)
+            with open(f_path, 'wb') as f_file:
+                f_file.write(content)
+            files[f_path], f_contents[f_path] = {'f_size': len(content)}, content
+
+        expected = self.hashes_instance.calculate_hashes(equal_files=sorted(files))
+        hashes_instance = duplicates.Hashes(extra_algs=['md5'])
+        threads = []
+
+        def add_hashed(f_size, add=hashes_instance.stats.add_hashed):
+            threads.append(threading.current_thread())
+            add(f_size)
+        hashes_instance.stats.add_hashed = add_hashed
+        with unittest.mock.patch.object(hashes_instance, 'get_hash_of_file') as get_hash_of_file:
+            result = hashes_instance.calculate_hashes(equal_files=sorted(files), files=files)
+        file_handler.delete_list_of_files(list(files))
+
+        get_hash_of_file.assert_not_called()
+        self.assertEqual(hashes_instance.stats.hashed_count, len(contents))
+        self.assertEqual(hashes_instance.stats.hashed_size, sum([len(content) for content in contents]))
+        self.assertEqual(set(threads), {threading.current_thread()})
+        self.assertEqual(sorted(result), sorted([f_hash for f_hash, h_meta in expected.items()
+                                                 if len(h_meta['f_paths']) > 1]))
+        for f_hash, h_meta in result.items():
+            self.assertEqual(h_meta['f_paths'], expected[f_hash]['f_paths'])
+            for f_path in h_meta['f_paths']:
+                self.assertEqual(h_meta['f_digests'][f_path]['md5'], hashlib.md5(f_contents[f_path]).hexdigest())
+
+    def test_resume(self):
+        """
+        Check resume method in Hashes class. Files from journal are not hashed again
+        if their size and modification time were not changed.
+        """
+        file_handler.create_file(TEST_FILE)
+        journal = duplicates.Journal(filename=TEST_JOURNAL)
+        hashes_instance = duplicates.Hashes(journal=journal)
+        f_hash = hashes_instance.calculate_hashes(equal_files=[TEST_FILE])
+
+        with self.subTest(msg='Test file from journal is not hashed again'):
+            entry = journal.replay()[0]
+            entry['digest'] = 'journaled_hash'
+            file_handler.delete_file(TEST_JOURNAL)
+            journal.add(entry)
+            journal.close()
+
+            self.assertEqual(hashes_instance.resume(), 1)
+            hashes = hashes_instance.calculate_hashes(equal_files=[TEST_FILE])
+            self.assertEqual(list(hashes), ['journaled_hash'])
+
+        with self.subTest(msg='Test changed file is hashed again'):
+            file_handler.create_file(TEST_FILE, n_bytes=2000)
+            file_handler.create_file(TEST_FILE)
+            os.utime(TEST_FILE, ns=(0, 0))
+            hashes = hashes_instance.calculate_hashes(equal_files=[TEST_FILE])
+            self.assertEqual(hashes, f_hash)
+
+        file_handler.delete_file(TEST_FILE)
+        file_handler.delete_file(TEST_JOURNAL)
+
+    def test_calculate_hashes_of_members(self):
+        """
+        Check that calculate_hashes method in Hashes class calculates hashes of archive members
+        equal to hashes of the same files on disk.
+        """
+        files = file_handler.create_files(filename=TEST_FILE, n=1, n_bytes=1000)
+        files += file_handler.create_files(filename=TEST_FILE.replace('.', '_big.'), n=1, n_bytes=2000)
+        self.create_archives(files)
+        members = [archive + duplicates.ARCHIVE_SEPARATOR + f for archive in TEST_ARCHIVES for f in files]
+
+        hashes = self.hashes_instance.calculate_hashes(equal_files=files + members)
+        file_handler.delete_list_of_files(files + TEST_ARCHIVES)
+
+        self.assertEqual(len(hashes), len(files))
+        for f_meta in hashes.values():
+            self.assertEqual(len(f_meta['f_paths']), len(TEST_ARCHIVES) + 1)
+
+    def test_get_hashes_of_unreadable_members(self):
+        """
+        Check that encrypted member of zip archive gets None hash and other members are still hashed
+        """
+        archive = TEST_ARCHIVES[0]
+        with zipfile.ZipFile(archive, 'w') as zip_archive:
+            zip_archive.writestr('encrypted.bin', b'secret')
+            zip_archive.writestr('plain.bin', b'plain')
+
+        # Set encryption flag of the first member in its local header and in central directory
+        with open(archive, 'r+b') as f_file:
+            content = bytearray(f_file.read())
+            for signature, offset in ((b'PK\x03\x04', 6), (b'PK\x01\x02', 8)):
+                content[content.index(signature) + offset] |= 0x1
+            f_file.seek(0)
+            f_file.write(content)
+        members = [archive + duplicates.ARCHIVE_SEPARATOR + name for name in ('encrypted.bin', 'plain.bin')]
+
+        result = self.hashes_instance.get_hashes_of_members(archive, members)
+        file_handler.delete_file(archive)
+
+        self.assertIsNone(result[members[0]])
+        self.assertEqual(result[members[1]], hashlib.sha1(b'plain').hexdigest())
+
+    def test_get_hash_of_sparse_file(self):
+        """
+        Check get_hash_of_file in Hashes class for sparse files. Holes are not read from disk,
+        but hash should be the same as hash of all bytes of file.
+        """
+        for desc, extents, f_size in SPARSE_CHECK:
+            with self.subTest(msg=desc):
+                file_handler.create_file(TEST_FILE, n_bytes=f_size)
+                with open(TEST_FILE, 'r+b') as f_file:
+                    for offset, data in extents:
+                        f_file.seek(offset)
+                        f_file.write(data)
+                with open(TEST_FILE, 'rb') as f_file:
+                    exp_hash = hashlib.sha1(f_file.read()).hexdigest()
+
+                result = self.hashes_instance.get_hash_of_file(f_path=TEST_FILE)
+                file_handler.delete_file(TEST_FILE)
+                self.assertEqual(result, exp_hash)
+
+    @unittest.skipUnless(hasattr(os, 'SEEK_DATA'), 'SEEK_DATA is not supported')
+    def test_get_hash_sparse_unsupported(self):
+        """
+        Check get_hash_of_file in Hashes class on filesystem without SEEK_DATA support. File is read densely
+        """
+        with open(TEST_FILE, 'wb') as f_file:
+            f_file.write(os.urandom(100000))
+        with open(TEST_FILE, 'rb') as f_file:
+            exp_hash = hashlib.sha1(f_file.read()).hexdigest()
+
+        lseek = os.lseek
+
+        def lseek_without_data(fd, offset, whence):
+            if whence in (os.SEEK_DATA, os.SEEK_HOLE):
+                raise OSError(duplicates.errno.EINVAL, 'Invalid argument')
+            return lseek(fd, offset, whence)
+
+        with unittest.mock.patch.object(duplicates.os, 'lseek', side_effect=lseek_without_data):
+            result = self.hashes_instance.get_hash_of_file(f_path=TEST_FILE)
+        file_handler.delete_file(TEST_FILE)
+        self.assertEqual(result, exp_hash)
+
+    @unittest.skipUnless(hasattr(os, 'posix_fadvise'), 'posix_fadvise is not supported')
+    def test_get_hash_cache_polite(self):
+        """
+        Check get_hash_of_file in Hashes class in cache-polite mode. Hash is the same as in usual mode,
+        every hashed block is dropped from page cache.
+        """
+        _, extents, f_size = SPARSE_CHECK[1]
+        file_handler.create_file(TEST_FILE, n_bytes=f_size)
+        with open(TEST_FILE, 'r+b') as f_file:
+            for offset, data in extents:
+                f_file.seek(offset)
+                f_file.write(data)
+        exp_hash = self.hashes_instance.get_hash_of_file(f_path=TEST_FILE)
+
+        hashes_instance = duplicates.Hashes(cache_polite=True, readahead=4096)
+        with unittest.mock.patch('os.posix_fadvise', wraps=os.posix_fadvise) as fadvise:
+            result = hashes_instance.get_hash_of_file(f_path=TEST_FILE)
+        file_handler.delete_file(TEST_FILE)
+
+        self.assertEqual(result, exp_hash)
+        advices = [call_args[0][3] for call_args in fadvise.call_args_list]
+        self.assertEqual(advices[0], os.POSIX_FADV_SEQUENTIAL)
+        self.assertIn(os.POSIX_FADV_WILLNEED, advices)
+        self.assertIn(os.POSIX_FADV_DONTNEED, advices)
+
     def test_add_hash(self):
         """
         Check add_hash. This method update hashes dict with new hashes and paths. Returns nothing.
@@ -160,11 +618,667 @@ class UnitHashes(Unit):
         self.assertEqual(len(hashes), len([]), msg='Test empty list of hashes and files')
 
 
+class UnitThrottle(Unit):
+
+    def tearDown(self):
+        if os.path.exists(TEST_THROTTLE):
+            file_handler.delete_file(TEST_THROTTLE)
+
+    def test_acquire(self):
+        """
+        Check acquire method of Throttle class. Reader waits only when bucket is empty, unlimited rate is not throttled
+        """
+        throttle = duplicates.Throttle(read_rate=1000, open_rate=0)
+
+        with unittest.mock.patch.object(duplicates.time, 'sleep') as sleep:
+            throttle.read(1000)
+            sleep.assert_not_called()
+
+            throttle.read(500)
+            self.assertAlmostEqual(sleep.call_args[0][0], 0.5, places=1)
+
+            sleep.reset_mock()
+            for _ in range(100):
+                throttle.open()
+            sleep.assert_not_called()
+
+    def test_control_file(self):
+        """
+        Check that rates of Throttle class are changed at runtime by control file and hashes are not changed
+        """
+        files = [TEST_FILE]
+        with open(TEST_FILE, 'wb') as f_file:
+            f_file.write(os.urandom(10000))
+        throttle = duplicates.Throttle(control_file=TEST_THROTTLE, interval=0)
+        with open(TEST_THROTTLE, 'w') as control_file:
+            json.dump({'max_read_rate': 1, 'max_open_rate': 5}, control_file)
+
+        with unittest.mock.patch.object(throttle, 'read', wraps=throttle.read) as read:
+            result = duplicates.Hashes(throttle=throttle).get_hash_of_file(files[0])
+        expected = duplicates.Hashes().get_hash_of_file(files[0])
+        file_handler.delete_list_of_files(files)
+
+        self.assertEqual(result, expected)
+        self.assertEqual(throttle.rates, {'read': 1024 ** 2, 'open': 5})
+        self.assertEqual(sum([call[0][0] for call in read.call_args_list]), 10000)
+
+    def test_control_file_wrong_rates(self):
+        """
+        Check that wrong control file is logged and current rates of Throttle class are kept
+        """
+        throttle = duplicates.Throttle(read_rate=1000, open_rate=10, control_file=TEST_THROTTLE, interval=0)
+        for control in [{'max_read_rate': '5'}, {'max_open_rate': -1}, {'max_read_rate': True}, [1, 2], 5]:
+            with self.subTest(msg=str(control)):
+                with open(TEST_THROTTLE, 'w') as control_file:
+                    json.dump(control, control_file)
+                throttle.control_mtime = None
+                throttle.check_control()
+                self.assertEqual(throttle.rates, {'read': 1000, 'open': 10})
+
+        file_handler.delete_file(TEST_THROTTLE)
+
+
+class UnitBackends(Unit):
+
+    def test_list_pages(self):
+        """
+        Check list_pages method of storage backends. Object store lists the same files as local filesystem
+        in pages, with one request per page, and find method of Files class keeps max_files semantics
+        """
+        old_dir, test_dir = self.create_file_structure(input_dict=WALK_CHECK[0][1])
+        local_backend = duplicates.LocalBackend(page_size=2)
+        object_store = duplicates.ObjectStoreBackend(root=test_dir, latency=0, page_size=2)
+
+        local_pages = list(local_backend.list_pages(test_dir))
+        pages = list(object_store.list_pages(test_dir))
+        sub_pages = list(object_store.list_pages(os.path.join(test_dir, 'dir0', 'dir1')))
+        files = duplicates.Files(backend=object_store).find(top=test_dir, max_files=3)
+        self.delete_file_structure(old_dir, test_dir)
+
+        self.assertTrue(all([len(page) <= 2 for page in local_pages + pages]))
+        self.assertEqual(sorted([(f_path, f_size) for f_path, f_size, _ in sum(pages, [])]),
+                         sorted([(f_path, f_size) for f_path, f_size, _ in sum(local_pages, [])]))
+        self.assertEqual(sorted(sum(sub_pages, [])),
+                         [(os.path.join(test_dir, 'dir0', 'dir1', 'dir2', 'file3.txt'), 40, None),
+                          (os.path.join(test_dir, 'dir0', 'dir1', 'file2.txt'), 30, None)])
+        self.assertEqual(object_store.requests['list'], len(pages) + len(sub_pages) + 2)
+        self.assertEqual(len(files), 3)
+
+    def test_stat(self):
+        """
+        Check that files are stat'ed by storage backend: once per found file on local filesystem
+        and with head request in object store
+        """
+        old_dir, test_dir = self.create_file_structure(input_dict=WALK_CHECK[0][1])
+        local_backend = duplicates.LocalBackend()
+        with unittest.mock.patch.object(local_backend, 'stat', wraps=local_backend.stat) as local_stat:
+            files = duplicates.Files(backend=local_backend).find(top=test_dir)
+
+        f_path = sorted(files)[0]
+        object_store = duplicates.ObjectStoreBackend(root=test_dir, latency=0)
+        f_size = duplicates.Files(backend=object_store).get_file_size(f_path)
+        journal = duplicates.Journal(filename=TEST_JOURNAL)
+        duplicates.Hashes(backend=object_store, journal=journal).calculate_hashes(equal_files=[f_path])
+        self.delete_file_structure(old_dir, test_dir)
+        file_handler.delete_file(TEST_JOURNAL)
+
+        self.assertEqual(local_stat.call_count, len(files))
+        self.assertEqual(f_size, files[f_path]['f_size'])
+        self.assertEqual(object_store.requests['head'], 2)
+
+    def test_read_blocks(self):
+        """
+        Check that object store reads file by ranged requests and hash is the same as for local filesystem
+        """
+        files = [TEST_FILE]
+        with open(TEST_FILE, 'wb') as f_file:
+            f_file.write(os.urandom(100000))
+        object_store = duplicates.ObjectStoreBackend(root=os.getcwd(), latency=0, range_size=30000)
+
+        result = duplicates.Hashes(backend=object_store, block_size=10000).get_hash_of_file(TEST_FILE)
+        expected = duplicates.Hashes().get_hash_of_file(TEST_FILE)
+        content = object_store.read_range(TEST_FILE, 99990, 100)
+        file_handler.delete_list_of_files(files)
+
+        self.assertEqual(result, expected)
+        self.assertEqual(len(content), 10)
+        self.assertEqual(object_store.requests['get'], 5)
+
+
+class UnitJournal(Unit):
+
+    def tearDown(self):
+        file_handler.delete_file(TEST_JOURNAL)
+
+    def test_add(self):
+        """
+        Check add method of Journal class. Entries are written to journal file only when batch is full.
+        Method flush writes the rest of entries.
+        """
+        for desc, entries, batch_size, expected in JOURNAL_CHECK:
+            with self.subTest(msg=desc):
+                journal = duplicates.Journal(filename=TEST_JOURNAL, batch_size=batch_size)
+                for entry in entries:
+                    journal.add(entry)
+
+                written = journal.replay()
+                journal.close()
+                self.assertEqual(len(written), expected)
+                self.assertEqual(journal.replay(), entries)
+                file_handler.delete_file(TEST_JOURNAL)
+
+    def test_replay(self):
+        """
+        Check replay method of Journal class. Broken line at the end of journal is skipped.
+        """
+        journal = duplicates.Journal(filename=TEST_JOURNAL)
+        journal.add({'path': 'path0'})
+        journal.close()
+        with open(TEST_JOURNAL, 'a') as journal_file:
+            journal_file.write('{"path": "pa')
+
+        self.assertEqual(journal.replay(), [{'path': 'path0'}])
+
+
+class UnitTrees(Unit):
+
+    def tearDown(self):
+        if os.path.exists(TEST_TREE_CACHE):
+            file_handler.delete_file(TEST_TREE_CACHE)
+
+    def test_find_duplicates(self):
+        """
+        Check find_duplicates and collapse methods of Trees class. Copied trees are found by Merkle digests
+        and their subtrees and files are collapsed
+        """
+        for desc, sizes, hashes, expected_trees, expected_hashes in TREES_CHECK:
+            with self.subTest(msg=desc):
+                trees_instance = duplicates.Trees()
+                duplicate_trees = trees_instance.find_duplicates(files=sizes.items(), hashes=hashes, top='top')
+                duplicate_files = dict([(f_hash, {'f_paths': h_meta['f_paths'], 'f_size': 0})
+                                        for f_hash, h_meta in hashes.items()])
+
+                self.assertEqual([d_meta['f_paths'] for d_meta in duplicate_trees.values()], expected_trees)
+                self.assertEqual(sorted(trees_instance.collapse(duplicate_files)), expected_hashes)
+
+    def test_tree_cache(self):
+        """
+        Check tree cache. Files of confirmed duplicated trees are not read again while they are not changed
+        """
+        old_dir, test_dir = self.create_file_structure(input_dict={'dir0': {}, 'dir1': {}})
+        for d_path in ['dir0', 'dir1']:
+            with open(os.path.join(d_path, TEST_FILE), 'wb') as f_file:
+                f_file.write(b'content')
+
+        files = duplicates.Files().find(top=test_dir)
+        hashes = duplicates.Hashes().calculate_hashes(sorted(files))
+        trees_instance = duplicates.Trees(cache_file=TEST_TREE_CACHE)
+        sizes = [(f_path, f_meta['f_size']) for f_path, f_meta in files.items()]
+        trees_instance.find_duplicates(files=sizes, hashes=hashes, top=test_dir)
+        trees_instance.save(hashes=hashes)
+
+        hashes_instance = duplicates.Hashes()
+        hashes_instance.finished.update(trees_instance.load())
+        with unittest.mock.patch.object(hashes_instance, 'get_hash_of_file') as get_hash_of_file:
+            result = hashes_instance.calculate_hashes(sorted(files))
+        os.remove(TEST_TREE_CACHE)
+        self.delete_file_structure(old_dir, test_dir)
+
+        self.assertEqual(result, hashes)
+        get_hash_of_file.assert_not_called()
+        self.assertEqual(duplicates.Trees(cache_file=TEST_TREE_CACHE).load(), {})
+
+
+class UnitEstimator(Unit):
+
+    def tearDown(self):
+        if os.path.exists(TEST_ESTIMATES):
+            file_handler.delete_file(TEST_ESTIMATES)
+
+    def test_estimate(self):
+        """
+        Check estimate method of Estimator class. Size of duplicates is in confidence interval and
+        it is exact if all or none of potential waste is duplicated
+        """
+        for desc, sizes, wastes, expected in ESTIMATE_CHECK:
+            with self.subTest(msg=desc):
+                estimator = duplicates.Estimator(sample_size=50, estimates_file=TEST_ESTIMATES, seed=0)
+                buckets = dict([(f_size, ['path{}'.format(i) for i in range(n)]) for f_size, n in sizes.items()])
+                with unittest.mock.patch.object(estimator, 'get_waste', side_effect=lambda f_size, _: wastes[f_size]):
+                    result = estimator.estimate(buckets.items)
+                estimator.save('top', result)
+
+                self.assertLessEqual(result['low'], expected)
+                self.assertGreaterEqual(result['high'], expected)
+                if expected in (0, result['max']):
+                    self.assertAlmostEqual(result['estimate'], expected)
+                self.assertEqual(estimator.load('top'), result)
+
+    def test_estimate_without_sample(self):
+        """
+        Check that estimate with empty sample gives only bounds of duplicates size
+        """
+        estimator = duplicates.Estimator(sample_size=0, estimates_file=TEST_ESTIMATES)
+        result = estimator.estimate({10: ['path0', 'path1']}.items)
+        self.assertEqual((result['low'], result['high'], result['max'], result['sampled']), (0, 10, 10, 0))
+
+    def test_compare_with_estimate(self):
+        """
+        Check that the last estimate is compared with size of duplicates from statistics
+        """
+        duplicates_instance = duplicates.Duplicates()
+        duplicates_instance.estimator = duplicates.Estimator(estimates_file=TEST_ESTIMATES)
+        duplicates_instance.estimator.save(duplicates_instance.top_dir, {'estimate': 1100, 'low': 900, 'high': 1200})
+        duplicates_instance.stats.duplicates_size = 1000
+        duplicates_instance.compare_with_estimate()
+
+        self.assertEqual(duplicates_instance.results['Estimate error'], '10.0 %')
+        self.assertTrue(duplicates_instance.results['Estimate in confidence interval'])
+
+
+class UnitDigestFilter(Unit):
+
+    def tearDown(self):
+        if os.path.exists(TEST_FILTER):
+            file_handler.delete_file(TEST_FILTER)
+
+    def test_bloom_filter(self):
+        """
+        Check BloomFilter class. Added keys are always found, rate of false positives is close to configured one
+        """
+        for fp_rate in [0.1, 0.01]:
+            with self.subTest(msg='Test false positive rate {}'.format(fp_rate)):
+                bloom_filter = duplicates.BloomFilter.create(n_items=1000, fp_rate=fp_rate)
+                for i in range(1000):
+                    bloom_filter.add('key{}'.format(i).encode())
+
+                self.assertTrue(all([bloom_filter.check('key{}'.format(i).encode()) for i in range(1000)]))
+                false_positives = sum([bloom_filter.check('other{}'.format(i).encode()) for i in range(10000)])
+                self.assertLess(false_positives / 10000, fp_rate * 2)
+
+    def test_save_load(self):
+        """
+        Check save and load methods of DigestFilter class. Loaded memory-mapped filter gives the same answers
+        """
+        hashes = dict([(hashlib.md5(str(i).encode()).hexdigest(), {'f_paths': ['path{}'.format(i)]}) for i in range(100)])
+        files = dict([('path{}'.format(i), {'f_size': i * 10}) for i in range(100)])
+        duplicates.DigestFilter.build(hashes=hashes, sizes=[f_meta['f_size'] for f_meta in files.values()],
+                                      alg='md5').save(TEST_FILTER)
+
+        digest_filter = duplicates.DigestFilter.load(TEST_FILTER)
+        self.assertEqual((digest_filter.alg, digest_filter.count), ('md5', 100))
+        self.assertTrue(all([digest_filter.check_digest(f_hash) for f_hash in hashes]))
+        self.assertTrue(all([digest_filter.check_size(f_meta['f_size']) for f_meta in files.values()]))
+        self.assertFalse(digest_filter.check_digest(hashlib.md5(b'other').hexdigest()) and
+                         digest_filter.check_size(5) and digest_filter.check_size(15))
+        digest_filter.close()
+
+        with open(TEST_FILTER, 'wb') as filter_file:
+            filter_file.write(b'broken')
+        self.assertIsNone(duplicates.DigestFilter.load(TEST_FILTER))
+
+
+class UnitCalibrator(Unit):
+
+    def setUp(self):
+        self.calibrator = duplicates.Calibrator(cache_file=TEST_CALIBRATION, block_sizes=[4096, 65536],
+                                                max_bytes=65536)
+        self.files = file_handler.create_files(filename=TEST_FILE, n=3, n_bytes=100000)
+
+    def tearDown(self):
+        file_handler.delete_list_of_files(self.files)
+        if os.path.isfile(TEST_CALIBRATION):
+            file_handler.delete_file(TEST_CALIBRATION)
+
+    def test_calibrate(self):
+        """
+        Check calibrate method of Calibrator class. It picks algorithm and block size from candidates
+        and caches the choice for this host.
+        """
+        choice = self.calibrator.calibrate(self.files)
+        self.assertIn(choice['alg'], duplicates.CALIBRATION_ALGS)
+        self.assertIn(choice['block_size'], [4096, 65536])
+        self.assertEqual(self.calibrator.load(), {self.calibrator.host: choice})
+
+        with unittest.mock.patch.object(self.calibrator, 'benchmark_algs') as benchmark:
+            self.assertEqual(self.calibrator.calibrate(self.files), choice)
+        benchmark.assert_not_called()
+
+    def test_calibrate_without_files(self):
+        """
+        Check calibrate method of Calibrator class without files. Default block size is used and it is not cached.
+        """
+        choice = self.calibrator.calibrate([])
+        self.assertIn(choice['alg'], duplicates.CALIBRATION_ALGS)
+        self.assertEqual(choice['block_size'], duplicates.BLOCK_SIZE)
+        self.assertEqual(self.calibrator.load(), {})
+
+
+class UnitDeduplicator(Unit):
+
+    def setUp(self):
+        journal = duplicates.Journal(filename=TEST_JOURNAL)
+        self.dedupe_instance = duplicates.Deduplicator(mode='hardlink', journal=journal)
+
+        # create files with the same content
+        self.f_size = 1000
+        self.files = file_handler.create_files(filename=TEST_FILE, n=3, n_bytes=self.f_size)
+
+    def tearDown(self):
+        file_handler.delete_list_of_files(self.files)
+        if os.path.isfile(TEST_JOURNAL):
+            file_handler.delete_file(TEST_JOURNAL)
+
+    def test_compare_files(self):
+        """
+        Check compare_files method of Deduplicator class. It compares content of files chunk by chunk.
+        """
+        with self.subTest(msg='Test equal files'):
+            self.assertTrue(self.dedupe_instance.compare_files(self.files[0], self.files[1], block_size=64))
+
+        with self.subTest(msg='Test files with different content'):
+            with open(self.files[1], 'r+b') as f_file:
+                f_file.seek(self.f_size - 1)
+                f_file.write(b'!')
+            self.assertFalse(self.dedupe_instance.compare_files(self.files[0], self.files[1], block_size=64))
+
+        with self.subTest(msg='Test missing file'):
+            self.assertFalse(self.dedupe_instance.compare_files(self.files[0], 'missing.bin'))
+
+    def test_deduplicate(self):
+        """
+        Check deduplicate method of Deduplicator class. All files in group except the first one
+        are replaced with links to the first one.
+        """
+        replaced, reclaimed = self.dedupe_instance.deduplicate({'hash0': {'f_paths': self.files}})
+
+        self.assertEqual(replaced, len(self.files) - 1)
+        self.assertEqual(reclaimed, (len(self.files) - 1) * self.f_size)
+        for f_path in self.files[1:]:
+            self.assertTrue(os.path.samefile(self.files[0], f_path))
+            self.assertFalse(os.path.exists(f_path + '.dedupe_backup'))
+
+    def test_deduplicate_empty_files(self):
+        """
+        Check that deduplicate method of Deduplicator class does not link empty files
+        """
+        files = file_handler.create_files(filename=TEST_FILE.replace('.', '_empty.'), n=2, n_bytes=0)
+        replaced, reclaimed = self.dedupe_instance.deduplicate({'hash0': {'f_paths': files, 'f_size': 0}})
+        linked = os.path.samefile(files[0], files[1])
+        file_handler.delete_list_of_files(files)
+
+        self.assertEqual((replaced, reclaimed), (0, 0))
+        self.assertFalse(linked)
+
+    def test_rollback(self):
+        """
+        Check rollback method of Deduplicator class. Finished replacements are replaced with independent copies,
+        interrupted replacements are restored from backup.
+        """
+        src, finished, interrupted = self.files
+        self.dedupe_instance.replace_file(src, finished)
+
+        # simulate replacement interrupted right after backup was created
+        backup = interrupted + '.dedupe_backup'
+        self.dedupe_instance.journal.add({'action': 'begin', 'src': src, 'dst': interrupted,
+                                          'tmp': interrupted + '.dedupe_tmp', 'backup': backup})
+        os.link(interrupted, backup)
+        file_handler.delete_file(interrupted)
+
+        restored = self.dedupe_instance.rollback()
+        self.assertEqual(restored, 2)
+        self.assertFalse(os.path.samefile(src, finished))
+        self.assertTrue(self.dedupe_instance.compare_files(src, interrupted))
+        self.assertFalse(os.path.exists(backup))
+        self.assertFalse(os.path.exists(TEST_JOURNAL))
+
+    def test_rollback_failed(self):
+        """
+        Check that journal keeps entries of files which were not restored, so rollback could be retried
+        """
+        src, finished, interrupted = self.files
+        self.dedupe_instance.replace_file(src, finished)
+
+        backup = interrupted + '.dedupe_backup'
+        self.dedupe_instance.journal.add({'action': 'begin', 'src': src, 'dst': interrupted,
+                                          'tmp': interrupted + '.dedupe_tmp', 'backup': backup})
+        os.link(interrupted, backup)
+        file_handler.delete_file(interrupted)
+
+        with unittest.mock.patch.object(duplicates.shutil, 'copy2', side_effect=PermissionError('denied')):
+            restored = self.dedupe_instance.rollback()
+        self.assertEqual(restored, 1)
+        self.assertTrue(self.dedupe_instance.compare_files(src, interrupted))
+        self.assertEqual(set([entry['dst'] for entry in self.dedupe_instance.journal.replay()]), {finished})
+
+        restored = self.dedupe_instance.rollback()
+        self.assertEqual(restored, 1)
+        self.assertFalse(os.path.samefile(src, finished))
+        self.assertFalse(os.path.exists(TEST_JOURNAL))
+
+
+class UnitChunks(Unit):
+
+    def setUp(self):
+        random.seed(0)
+        self.content = bytes([random.randint(0, 255) for _ in range(100000)])
+
+    def get_chunks(self, content, block_size=duplicates.BLOCK_SIZE):
+        chunker = duplicates.Chunker()
+        for start in range(0, len(content), block_size):
+            chunker.update(content[start:start + block_size])
+        return chunker.finish()
+
+    def test_chunker(self):
+        """
+        Check Chunker class. Chunks do not depend on size of blocks and on offset of content in file.
+        """
+        chunks = self.get_chunks(self.content)
+
+        with self.subTest(msg='Test chunks cover whole content'):
+            self.assertEqual(sum([size for _, size in chunks]), len(self.content))
+            self.assertTrue(all([size <= duplicates.CHUNK_MAX_SIZE for _, size in chunks]))
+
+        with self.subTest(msg='Test chunks do not depend on block size'):
+            self.assertEqual(self.get_chunks(self.content, block_size=1000), chunks)
+
+        with self.subTest(msg='Test chunks do not depend on offset'):
+            shifted_chunks = self.get_chunks(b'prefix' + self.content)
+            self.assertEqual(shifted_chunks[1:], chunks[1:])
+
+    def test_chunk_index(self):
+        """
+        Check ChunkIndex class. It counts bytes shared by files in total and per pair of files.
+        """
+        chunk_index = duplicates.ChunkIndex()
+        chunks = self.get_chunks(self.content)
+        chunk_index.add_file('path0', chunks)
+        chunk_index.add_file('path1', self.get_chunks(b'prefix' + self.content))
+        chunk_index.add_file('path2', self.get_chunks(b'other content'))
+
+        shared_size = len(self.content) - chunks[0][1]
+        self.assertEqual(chunk_index.get_shared_size(), shared_size)
+        self.assertEqual(chunk_index.get_shared_pairs(), [(('path0', 'path1'), shared_size)])
+
+
+@unittest.skipUnless(hasattr(duplicates.socketserver, 'ThreadingUnixStreamServer'), 'Unix sockets are not supported')
+class UnitIndexDaemon(Unit):
+
+    def setUp(self):
+        self.files = file_handler.create_files(filename=TEST_FILE, n=2, n_bytes=1000)
+        self.index = duplicates.DuplicatesIndex()
+        self.index.build([(f_path, 1000) for f_path in self.files])
+
+        self.daemon = duplicates.IndexDaemon(index=self.index, socket_path=TEST_SOCKET)
+        self.daemon.start()
+        self.thread = threading.Thread(target=self.daemon.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.daemon.shutdown()
+        self.thread.join()
+        file_handler.delete_list_of_files(self.files)
+
+    def query(self, request):
+        return duplicates.query_index(request, socket_path=TEST_SOCKET)
+
+    def test_lookup(self):
+        """
+        Check lookup requests to index daemon by size, by digest and by path.
+        """
+        f_hash = self.index.lookup_path(self.files[0])['f_hash']
+
+        self.assertEqual(self.query({'op': 'size', 'size': 1000}), {'ok': True, 'result': self.files})
+        self.assertEqual(self.query({'op': 'size', 'size': 2000}), {'ok': True, 'result': []})
+        self.assertEqual(self.query({'op': 'digest', 'digest': f_hash}), {'ok': True, 'result': self.files})
+        self.assertEqual(self.query({'op': 'path', 'path': self.files[1]}),
+                         {'ok': True, 'result': {'f_size': 1000, 'f_hash': f_hash}})
+        self.assertFalse(self.query({'op': 'unknown'})['ok'])
+        self.assertFalse(self.query({'op': 'size'})['ok'])
+
+    def test_add_remove(self):
+        """
+        Check notifications about added, changed and removed files.
+        """
+        file_handler.create_file(self.files[1], n_bytes=2000)
+        self.assertEqual(self.query({'op': 'add', 'path': self.files[1]})['result']['f_size'], 2000)
+        self.assertEqual(self.query({'op': 'size', 'size': 1000})['result'], self.files[:1])
+        self.assertEqual(self.query({'op': 'size', 'size': 2000})['result'], self.files[1:])
+
+        self.assertTrue(self.query({'op': 'remove', 'path': self.files[0]})['result'])
+        self.assertEqual(self.query({'op': 'size', 'size': 1000})['result'], [])
+        self.assertEqual(self.query({'op': 'stats'})['result'], {'files': 1, 'sizes': 1, 'digests': 1})
+
+    def test_add_missing_file(self):
+        """
+        Check that missing file is not added to index and error is returned.
+        """
+        response = self.query({'op': 'add', 'path': TEST_FILE + '_missing'})
+        self.assertFalse(response['ok'])
+        self.assertIsNone(self.index.lookup_path(TEST_FILE + '_missing'))
+        self.assertEqual(self.query({'op': 'stats'})['result'], {'files': 2, 'sizes': 1, 'digests': 1})
+
+    def test_start_keeps_regular_file(self):
+        """
+        Check that regular file on socket path is not removed on start.
+        """
+        f_path = TEST_SOCKET + '_file'
+        file_handler.create_file(f_path, n_bytes=10)
+        daemon = duplicates.IndexDaemon(index=self.index, socket_path=f_path)
+
+        with self.assertRaises(OSError):
+            daemon.start()
+        self.assertTrue(os.path.isfile(f_path))
+        file_handler.delete_file(f_path)
+
+
 class UnitDuplicates(Unit):
 
     def setUp(self):
         self.duplicates_instance = duplicates.Duplicates()
 
+    def test_iter_files(self):
+        """
+        Check iter_files and iter_buckets methods in Duplicates class. All found files are given
+        in the same way from files dict, from sorted runs and from columnar index
+        """
+        input_dict = {'dir0': {'file0.txt': 10, 'file1.txt': 10}, 'dir1': {'file2.txt': 10, 'file3.txt': 20, 'file4.txt': 30}}
+        old_dir, test_dir = self.create_file_structure(input_dict=input_dict)
+        expected_files, expected_buckets = None, None
+
+        for desc, kwargs in [('Test files dict', {}), ('Test sorted runs', {'max_memory': 0.0001}),
+                             ('Test columnar index', {'columnar': True})]:
+            with self.subTest(msg=desc):
+                duplicates_instance = duplicates.Duplicates()
+                duplicates_instance.files_obj = duplicates.Files(**kwargs)
+                duplicates_instance.find_all_files(top_dir=test_dir, max_files=100)
+                result_files = sorted(duplicates_instance.iter_files())
+                result_buckets = sorted(duplicates_instance.iter_buckets())
+                duplicates_instance.files_obj.close()
+
+                expected_files = expected_files if expected_files else result_files
+                expected_buckets = expected_buckets if expected_buckets else result_buckets
+                self.assertEqual(len(result_files), 5)
+                self.assertEqual([(f_size, len(f_paths)) for f_size, f_paths in result_buckets], [(10, 3)])
+                self.assertEqual(result_files, expected_files)
+                self.assertEqual(result_buckets, expected_buckets)
+
+        self.delete_file_structure(old_dir, test_dir)
+
+    def test_serve_index_all_modes(self):
+        """
+        Check that serve_index method in Duplicates class indexes all found files with files dict,
+        with sorted runs and with columnar index
+        """
+        input_dict = {'dir0': {'file0.txt': 10, 'file1.txt': 10}, 'dir1': {'file2.txt': 20}}
+        old_dir, test_dir = self.create_file_structure(input_dict=input_dict)
+        sigterm_handler = signal.getsignal(signal.SIGTERM)
+
+        for desc, kwargs in [('Test files dict', {}), ('Test sorted runs', {'max_memory': 0.0001}),
+                             ('Test columnar index', {'columnar': True})]:
+            with self.subTest(msg=desc):
+                duplicates_instance = duplicates.Duplicates()
+                duplicates_instance.files_obj = duplicates.Files(**kwargs)
+                duplicates_instance.find_all_files(top_dir=test_dir, max_files=100)
+                with unittest.mock.patch.object(duplicates, 'IndexDaemon') as index_daemon:
+                    duplicates_instance.serve_index(socket_path=TEST_SOCKET)
+                index = index_daemon.call_args[1]['index']
+
+                self.assertEqual(len(index.paths), 3)
+                self.assertEqual(len(index.lookup_size(10)), 2)
+
+        signal.signal(signal.SIGTERM, sigterm_handler)
+        self.delete_file_structure(old_dir, test_dir)
+
+    def test_calibrate_sorted_runs(self):
+        """
+        Check that files of the first size buckets are sampled for calibration in external-memory mode
+        """
+        input_dict = {'dir0': {'file0.txt': 10, 'file1.txt': 10}, 'dir1': {'file2.txt': 20, 'file3.txt': 20}}
+        old_dir, test_dir = self.create_file_structure(input_dict=input_dict)
+        duplicates_instance = duplicates.Duplicates()
+        duplicates_instance.block_size = 'auto'
+        duplicates_instance.files_obj = duplicates.Files(max_memory=0.0001)
+        duplicates_instance.find_all_files(top_dir=test_dir, max_files=100)
+
+        choice = {'alg': duplicates.DEFAULT_ALG, 'block_size': 4096}
+        with unittest.mock.patch.object(duplicates_instance.calibrator, 'calibrate', return_value=choice) as calibrate:
+            duplicates_instance.get_files_hashes(equal_files=duplicates_instance.files_obj.iter_equal_files())
+        duplicates_instance.files_obj.close()
+        self.delete_file_structure(old_dir, test_dir)
+
+        self.assertEqual(len(calibrate.call_args[0][0]), 2)
+        self.assertEqual(duplicates_instance.block_size, 4096)
+
+    def test_filter_all_modes(self):
+        """
+        Check export_digest_filter and check_with_filter methods in Duplicates class. All found files are exported
+        and matched with files dict, with sorted runs and with columnar index
+        """
+        input_dict = {'dir0': {'file0.txt': 10, 'file1.txt': 20}, 'dir1': {'file2.txt': 30}}
+        old_dir, test_dir = self.create_file_structure(input_dict=input_dict)
+        filter_file = os.path.join(old_dir, TEST_FILTER)
+
+        for desc, kwargs in [('Test files dict', {}), ('Test sorted runs', {'max_memory': 0.0001}),
+                             ('Test columnar index', {'columnar': True})]:
+            with self.subTest(msg=desc):
+                duplicates_instance = duplicates.Duplicates()
+                duplicates_instance.files_obj = duplicates.Files(**kwargs)
+                duplicates_instance.find_all_files(top_dir=test_dir, max_files=100)
+                digest_filter = duplicates_instance.export_digest_filter(filter_file=filter_file)
+
+                duplicates_instance.find_all_files(top_dir=test_dir, max_files=100)
+                matches = duplicates_instance.check_with_filter(filter_file=filter_file)
+                duplicates_instance.files_obj.close()
+                duplicates_instance.calculate_filter_results()
+
+                self.assertEqual(digest_filter.count, 3)
+                self.assertEqual(len(matches), 3)
+                self.assertEqual(duplicates_instance.filter_matches_size, 60)
+
+        file_handler.delete_file(filter_file)
+        self.delete_file_structure(old_dir, test_dir)
+
     def test_find_all_files(self):
         """
         Check find_all_files method in Duplicates class. This method try to find all files in
@@ -228,6 +1342,36 @@ class UnitDuplicates(Unit):
                 result = self.duplicates_instance.find_duplicates(hashes=input_dict)
                 self.assertEqual(expected, result)
 
+    def test_push_to_top(self):
+        """
+        Check push_to_top method. Bounded heap keeps only top N groups with the biggest size of duplicated files.
+        """
+        for desc, duplicates_dict, top, expected in TOP_CHECK:
+            with self.subTest(msg=desc):
+                top_heap = []
+                for f_hash, f_meta in duplicates_dict.items():
+                    duplicated_size = (len(f_meta['f_paths']) - 1) * f_meta['f_size']
+                    self.duplicates_instance.push_to_top(top_heap, f_hash, duplicated_size, top=top)
+
+                self.assertEqual([f_hash for _, f_hash in sorted(top_heap, reverse=True)], expected)
+
+    def test_show_duplicates_in_console(self):
+        """
+        Check show_duplicates_in_console method. With top N only top groups are shown.
+        """
+        _, hashes_dict, top, expected = TOP_CHECK[0]
+        self.duplicates_instance.top = top
+        self.duplicates_instance.files = dict([(f_path, {'f_size': m['f_size']})
+                                               for m in hashes_dict.values() for f_path in m['f_paths']])
+        self.duplicates_instance.find_duplicates(hashes=dict([(h, {'f_paths': m['f_paths']})
+                                                              for h, m in hashes_dict.items()]))
+        self.assertEqual(self.duplicates_instance.top_duplicates, expected)
+
+        with unittest.mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            self.duplicates_instance.show_duplicates_in_console()
+        self.assertIn('path4', stdout.getvalue())
+        self.assertNotIn('path0', stdout.getvalue())
+
     def test_get_file_size(self):
         """
         Check get_file_size method in Duplicates class. This method try to get file size from